@@ -8,19 +8,32 @@ import traceback
 import random
 import tempfile
 import re
+import time
+import atexit
+import heapq
+import io
+import mmap
+import hashlib
+import sqlite3
+from collections import OrderedDict, deque
+from itertools import count, islice
+from contextlib import contextmanager
 from sticker_picker import install_sticker_plugin
 from sticker_picker import pick_sticker_dialog
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 
-from PySide6.QtCore import Qt, Signal, QTimer, QEvent, QUrl
-from PySide6.QtGui import (QPixmap, QAction, QPalette, QColor, QGuiApplication, QImage, QKeySequence, QDesktopServices)
+from PySide6.QtCore import (Qt, Signal, QTimer, QEvent, QUrl, QCoreApplication,
+                            QAbstractListModel, QModelIndex, QRect, QRectF, QPoint, QSize)
+from PySide6.QtGui import (QPixmap, QAction, QPalette, QColor, QGuiApplication, QImage, QKeySequence, QDesktopServices,
+                           QPainter, QPainterPath, QLinearGradient, QStaticText, QTextOption, QFont, QFontMetrics, QPen, QBrush)
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel,
     QListWidget, QListWidgetItem, QPushButton, QLineEdit, QFileDialog,
     QMessageBox, QSplitter, QScrollArea, QFrame, QComboBox, QCheckBox,
-    QToolButton, QDialog, QFormLayout, QSizePolicy, QInputDialog, QMenu
+    QToolButton, QDialog, QFormLayout, QSizePolicy, QInputDialog, QMenu,
+    QListView, QAbstractItemView, QStyledItemDelegate
 )
 
 from qasync import QEventLoop
@@ -40,17 +53,67 @@ PINS_FILE = ROOT / "pins.json"                    # ГЛОБАЛЬНЫЕ зак
 PROXIES_FILE = ROOT / "proxies.json"
 ACCOUNTS_CACHE_FILE = ROOT / "accounts_cache.json"
 REACTIONS_CACHE_FILE = ROOT / "reactions_cache.json"   # ref|msg|uid -> emoji
+RATE_STATS_FILE = ROOT / "rate_stats.json"        # выгрузка статистики лимитера
+RPC_STATS_FILE = ROOT / "rpc_stats.json"          # выгрузка задержек/таймаутов запросов
+ENTITY_CACHE_FILE = ROOT / "entity_cache.json"    # ref -> (тип пира, id, access_hash) по аккаунтам
+USERNAMES_FILE = ROOT / "usernames.json"          # общий справочник username -> (тип пира, id)
+MESSAGES_DB_FILE = ROOT / "messages.sqlite3"      # локальная копия истории чатов (SQLite, WAL)
+SETTINGS_FILE = ROOT / "settings.json"            # тонкая настройка (переопределяет _DEFAULT_SETTINGS)
+
+_DEFAULT_SETTINGS = {
+    "boot_concurrency": 12,          # сколько сессий подключаем одновременно
+    "boot_session_timeout": 45.0,    # сек на одну сессию: connect + get_me + проверка
+    "hibernate_accounts": False,     # аккаунты из кэша стартуют отключёнными, коннект по требованию
+    "hibernate_idle_sec": 600,       # простой, после которого аккаунт снова засыпает
+    "state_flush_ms": 1000,          # как часто сбрасываем накопленные изменения json-состояния
+    "peer_flood_cooldown_sec": 1800, # PeerFlood срока не сообщает — отдыхаем столько
+    # бюджет времени на вызов (очередь диспетчера + сам RPC) по полосам; transfer — загрузки/скачивания
+    "rpc_timeout_sec": {"interactive": 20, "normal": 30, "background": 15, "transfer": 300},
+    "degraded_cooldown_sec": 120,    # сколько аккаунт считается «медленным» после таймаута
+    "entity_cache_ttl_sec": 7 * 24 * 3600,  # сколько доверяем закешированному резолву ref
+    "entity_cache_mem_size": 512,    # сущностей в памяти (LRU)
+    "username_dir_ttl_sec": 7 * 24 * 3600,  # ник может сменить владельца — перепроверяем не реже
+    "discussion_cache_ttl_sec": 1800,      # канал → чат обсуждения (в т.ч. «обсуждения нет»)
+    "discussion_root_ttl_sec": 24 * 3600,  # (канал, пост) → id корня ветки; почти не меняется
+    "reaction_policy_ttl_sec": 900,  # сколько доверяем закешированному списку разрешённых реакций чата
+    "history_page_size": 60,         # сообщений в странице истории чата
+    "history_max_pages": 6,          # сколько страниц держим; дальний край выгружается
+    "history_prefetch_screens": 1.5, # догружаем, когда до края осталось столько экранов
+    "message_store_per_chat": 600,   # локальное хранилище: сколько последних сообщений держим на чат
+    "message_store_max_rows": 50000, # и сколько всего; сверх — удаляются самые старые по дате
+    "hedged_reads": False,           # дублировать медленное чтение вторым аккаунтом, берём первый ответ
+    "hedge_min_delay_sec": 0.3,      # задержка дубля = max(этого, p95 вида запроса)
+    "hedge_default_delay_sec": 1.5,  # пока статистики нет
+    "broadcast_concurrency": 4,      # рассылка: сколько аккаунтов отправляют одновременно
+    "broadcast_jitter_sec": [0.4, 2.0],   # случайная пауза перед отправкой каждым аккаунтом
+    "rpc_in_flight_per_account": 6,  # сколько RPC одного аккаунта идут параллельно
+    "upload_cache_ttl_sec": 3600,    # сколько переиспользуем загруженный InputFile без повторной загрузки
+    # token bucket на аккаунт и класс действия: per_min — скорость пополнения, burst — запас.
+    # per_account: {"<user_id>": {"send": {"per_min": .., "burst": ..}}} — переопределения
+    "rate_limits": {
+        "send":    {"per_min": 20, "burst": 3},
+        "react":   {"per_min": 30, "burst": 5},
+        "join":    {"per_min": 4,  "burst": 2},
+        "resolve": {"per_min": 15, "burst": 5},
+        "background": {"resolve": {"per_min": 10, "burst": 2}},  # отдельные вёдра для фоновой полосы
+        "per_account": {},
+    },
+}
 
 # -----------------------------
 # Telethon
 # -----------------------------
-from telethon import TelegramClient, utils
+from telethon import TelegramClient, utils, events
 from telethon.errors import (
     SessionPasswordNeededError, PhoneCodeInvalidError, PhoneNumberBannedError,
     UserDeactivatedBanError, UserDeactivatedError, SessionRevokedError,
-    AuthKeyUnregisteredError, PeerFloodError, FloodWaitError, RPCError
+    AuthKeyUnregisteredError, PeerFloodError, FloodWaitError, RPCError,
+    ChatWriteForbiddenError, ChannelPrivateError, UserBannedInChannelError, ChatAdminRequiredError,
+    ChannelInvalidError, PeerIdInvalidError, ChatIdInvalidError, UsernameNotOccupiedError, UsernameInvalidError,
+    UserAlreadyParticipantError
 )
 from telethon.tl import types, functions
+from telethon.extensions import BinaryReader
 from telethon.errors import PasswordHashInvalidError, EmailUnconfirmedError
 from telethon.tl.functions.channels import GetFullChannelRequest, JoinChannelRequest
 from telethon.tl.functions.messages import (SendReactionRequest, GetDiscussionMessageRequest, GetRepliesRequest, GetBotCallbackAnswerRequest)
@@ -102,6 +165,7 @@ def human_dialog_title(dlg):
     return title
 
 def load_json(path: Path, default):
+    state_writer.flush(path)  # читаем то, что уже «записали», даже если оно ещё в буфере
     if not path.exists():
         return default
     try:
@@ -115,8 +179,101 @@ def save_json(path: Path, data):
     tmp = path.with_suffix(".tmp.json")
     with open(tmp, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
     tmp.replace(path)
 
+class JsonStateWriter:
+    """
+    Копит записи json-состояния (прокси, кэш аккаунтов, пины, реакции) и сбрасывает
+    их разом: не чаще раза в state_flush_ms, внутри batch() — один раз в конце.
+    Данные можно передать callable — он вызовется в момент записи.
+    Сама запись — save_json (fsync + атомарный replace), остаток дописывается при выходе.
+    """
+    def __init__(self):
+        self._pending: Dict[Path, object] = {}
+        self._timer: Optional[QTimer] = None
+        self._holds = 0
+
+    def write(self, path: Path, data):
+        self._pending[path] = data
+        if not self._holds:
+            self._arm()
+
+    def _arm(self):
+        if QCoreApplication.instance() is None:
+            return self.flush()
+        if self._timer is None:
+            self._timer = QTimer()
+            self._timer.setSingleShot(True)
+            self._timer.timeout.connect(self.flush)
+        if not self._timer.isActive():
+            self._timer.start(int(SETTINGS.get("state_flush_ms") or 0))
+
+    def flush(self, path: Optional[Path] = None):
+        paths = [path] if path is not None else list(self._pending)
+        for p in paths:
+            if p not in self._pending:
+                continue
+            data = self._pending.pop(p)
+            try:
+                save_json(p, data() if callable(data) else data)
+            except Exception as e:
+                print(f"[STATE] Не удалось записать {p.name}: {e}")
+
+    @contextmanager
+    def batch(self):
+        self._holds += 1
+        try:
+            yield self
+        finally:
+            self._holds -= 1
+            if not self._holds:
+                self.flush()
+
+state_writer = JsonStateWriter()
+atexit.register(state_writer.flush)
+
+def _session_key_hash(path: Path) -> str:
+    """
+    Отпечаток auth_key из файла сессии Telethon (без подключения). В отличие от mtime, не меняется,
+    пока сессия та же: Telethon переписывает файл ради pts/сущностей, но не ключа.
+    """
+    try:
+        db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            row = db.execute("SELECT dc_id, auth_key FROM sessions").fetchone()
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return ""
+    if not row or not row[1]:
+        return ""
+    return hashlib.sha256(bytes(row[1])).hexdigest()[:32] + f":{row[0]}"
+
+def load_settings() -> dict:
+    """Дефолты + settings.json; вложенные словари сливаются на один уровень."""
+    data = load_json(SETTINGS_FILE, {})
+    out = {}
+    for k, v in _DEFAULT_SETTINGS.items():
+        user_v = data.get(k, v)
+        if isinstance(v, dict) and isinstance(user_v, dict):
+            out[k] = {**v, **user_v}
+        else:
+            out[k] = user_v
+    for k, v in data.items():
+        out.setdefault(k, v)
+    return out
+
+SETTINGS = load_settings()
+
+def save_setting(key: str, value):
+    """Меняет один ключ в SETTINGS и в settings.json (остальное в файле не трогаем)."""
+    SETTINGS[key] = value
+    data = load_json(SETTINGS_FILE, {})
+    data[key] = value
+    save_json(SETTINGS_FILE, data)
+
 # ---- ГЛОБАЛЬНЫЕ закрепы ----
 def load_pins() -> List[str]:
     """Миграция: если старый формат был словарь {uid:[...]}, превращаем в единый список уникальных ссылок."""
@@ -132,7 +289,7 @@ def load_pins() -> List[str]:
     return data
 
 def save_pins(pins: List[str]):
-    save_json(PINS_FILE, pins)
+    state_writer.write(PINS_FILE, pins)
 
 def entity_ref(entity) -> str:
     uname = getattr(entity, "username", None) or None
@@ -163,25 +320,49 @@ async def resolve_ref(client: TelegramClient, ref: str):
         pass
     return None
 
-async def ensure_join(client: TelegramClient, entity):
-    try:
-        if isinstance(entity, types.Channel):
-            await client(JoinChannelRequest(entity))
-    except Exception:
-        pass
+DEFAULT_REACTION_EMOJIS = ["❤️", "👍", "😂", "🔥", "👏", "😮", "😢", "👎"]
+
+
+class ReactionPolicyCache:
+    """
+    Разрешённые реакции по каналам (общие для всех аккаунтов): тип ChatReactions* и список эмодзи, с TTL.
+    Заполняется из любого GetFullChannelRequest, сбрасывается по UpdateChannel.
+    """
+    def __init__(self, ttl_sec: float):
+        self.ttl = float(ttl_sec)
+        self._data: Dict[int, Tuple[float, str, List[str]]] = {}  # channel_id -> (ts, тип, эмодзи)
+
+    def get(self, channel_id: int) -> Optional[List[str]]:
+        hit = self._data.get(channel_id)
+        if not hit or time.time() - hit[0] >= self.ttl:
+            return None
+        return hit[2]
+
+    def put(self, channel_id: int, available_reactions) -> List[str]:
+        out = DEFAULT_REACTION_EMOJIS
+        if isinstance(available_reactions, types.ChatReactionsSome):
+            out = [r.emoticon for r in available_reactions.reactions if isinstance(r, types.ReactionEmoji)] or out
+        kind = type(available_reactions).__name__ if available_reactions is not None else "None"
+        self._data[channel_id] = (time.time(), kind, out)
+        return out
+
+    def invalidate(self, channel_id: int):
+        self._data.pop(channel_id, None)
+
+reaction_policy = ReactionPolicyCache(SETTINGS["reaction_policy_ttl_sec"])
+
 
 async def get_allowed_reaction_emojis(client: TelegramClient, entity) -> List[str]:
-    default = ["❤️", "👍", "😂", "🔥", "👏", "😮", "😢", "👎"]
     try:
         if isinstance(entity, types.Channel):
+            cached = reaction_policy.get(entity.id)
+            if cached is not None:
+                return cached
             full = await client(GetFullChannelRequest(entity))
-            ar = getattr(full.full_chat, "available_reactions", None)
-            if isinstance(ar, types.ChatReactionsSome):
-                out = [r.emoticon for r in ar.reactions if isinstance(r, types.ReactionEmoji)]
-                return out or default
-        return default
+            return reaction_policy.put(entity.id, getattr(full.full_chat, "available_reactions", None))
+        return DEFAULT_REACTION_EMOJIS
     except Exception:
-        return default
+        return DEFAULT_REACTION_EMOJIS
 
 def force_dark_palette(app: QApplication):
     p = QPalette()
@@ -208,7 +389,7 @@ def _load_proxies_config() -> dict:
     return load_json(PROXIES_FILE, _default_proxies_config())
 
 def _save_proxies_config(cfg: dict):
-    save_json(PROXIES_FILE, cfg)
+    state_writer.write(PROXIES_FILE, cfg)
 
 def _parse_proxy_line(line: str) -> Optional[dict]:
     line = (line or "").strip()
@@ -346,6 +527,800 @@ class QRLoginDialog(QDialog):
         self.btn_pwd.show()
         self.pwd_edit.setFocus()
 
+# =============== Рассылка ===============
+class BroadcastDialog(QDialog):
+    """Выбор аккаунтов для рассылки и построчный статус по каждому (ok / лимит / нет доступа)."""
+    startRequested = Signal(list)  # [user_id, ...]
+
+    def __init__(self, title: str, accounts: List[Tuple[int, str, bool]], parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Рассылка с аккаунтов")
+        self.resize(460, 560)
+        v = QVBoxLayout(self)
+        info = QLabel(f"Чат: {title}", self); info.setWordWrap(True)
+        v.addWidget(info)
+
+        self.list = QListWidget(self)
+        self._items: Dict[int, QListWidgetItem] = {}
+        for uid, name, cooling in accounts:
+            it = QListWidgetItem(f"{name} ({uid})" + ("  — на лимите" if cooling else ""))
+            it.setData(Qt.UserRole, uid)
+            it.setFlags(it.flags() | Qt.ItemIsUserCheckable)
+            it.setCheckState(Qt.Unchecked if cooling else Qt.Checked)
+            self.list.addItem(it)
+            self._items[uid] = it
+        v.addWidget(self.list, 1)
+
+        row = QHBoxLayout()
+        btn_all = QPushButton("Все", self); btn_none = QPushButton("Никого", self)
+        btn_all.clicked.connect(lambda: self._check_all(True))
+        btn_none.clicked.connect(lambda: self._check_all(False))
+        self.btn_start = QPushButton("Отправить", self)
+        self.btn_close = QPushButton("Закрыть", self)
+        self.btn_start.clicked.connect(self._emit_start)
+        self.btn_close.clicked.connect(self.close)
+        row.addWidget(btn_all); row.addWidget(btn_none); row.addStretch(1)
+        row.addWidget(self.btn_start); row.addWidget(self.btn_close)
+        v.addLayout(row)
+
+        self.summary = QLabel("", self)
+        v.addWidget(self.summary)
+
+    def _check_all(self, on: bool):
+        for it in self._items.values():
+            it.setCheckState(Qt.Checked if on else Qt.Unchecked)
+
+    def _emit_start(self):
+        uids = [uid for uid, it in self._items.items() if it.checkState() == Qt.Checked]
+        if not uids:
+            return
+        self.btn_start.setEnabled(False)
+        for uid in uids:
+            self.set_status(uid, "в очереди…", "#9fb3d9")
+        self.startRequested.emit(uids)
+
+    def set_status(self, uid: int, text: str, color: str = "#eaf2ff"):
+        it = self._items.get(uid)
+        if not it:
+            return
+        base = it.text().split("  — ", 1)[0]
+        it.setText(f"{base}  — {text}")
+        it.setForeground(QColor(color))
+
+    def set_summary(self, text: str):
+        self.summary.setText(text)
+
+# =============== Лимиты запросов ===============
+class TokenBucket:
+    def __init__(self, per_min: float, burst: float):
+        self.rate = max(1e-6, float(per_min) / 60.0)   # токенов в секунду
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Забирает токен (в долг, если нужно) и возвращает, сколько секунд ждать."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1.0
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        """Вернуть токен: вызов, под который он взят, так и не состоялся (отмена/таймаут)."""
+        self.tokens = min(self.burst, self.tokens + 1.0)
+
+class RateLimiter:
+    """
+    Token bucket на (аккаунт, класс действия): send / react / join / resolve.
+    acquire() не бросает ошибку, а ждёт, пока появится ёмкость — так держимся
+    чуть ниже порогов FloodWait. Лимиты — SETTINGS["rate_limits"], для аккаунта
+    их можно переопределить в per_account. Фоновые вызовы берут токены
+    из своего ведра (rate_limits.background) и не копят долг перед кликами пользователя.
+    """
+    ACTIONS = ("send", "react", "join", "resolve")
+
+    def __init__(self, cfg: dict):
+        self._cfg = cfg
+        self._buckets: Dict[Tuple[int, str], TokenBucket] = {}
+        self._stats: Dict[Tuple[int, str], Dict[str, float]] = {}
+
+    def _limit_for(self, uid: int, action: str, background: bool = False) -> Optional[dict]:
+        own = (self._cfg.get("per_account") or {}).get(str(uid)) or {}
+        lim = own.get(action) or self._cfg.get(action)
+        if background:
+            lim = (self._cfg.get("background") or {}).get(action) or lim
+        return lim if isinstance(lim, dict) and lim.get("per_min") else None
+
+    @staticmethod
+    def _key(uid: int, action: str, background: bool) -> Tuple[int, str]:
+        return (uid, f"{action}:bg" if background else action)
+
+    async def acquire(self, uid: int, action: str, background: bool = False):
+        key = self._key(uid, action, background)
+        b = self._buckets.get(key)
+        if b is None:
+            lim = self._limit_for(uid, action, background)
+            if not lim:
+                return
+            b = self._buckets[key] = TokenBucket(lim["per_min"], lim.get("burst", 1))
+        wait = b.reserve()
+        st = self._stats.setdefault(key, {"calls": 0, "delayed": 0, "wait_sec": 0.0, "max_wait_sec": 0.0})
+        st["calls"] += 1
+        if wait > 0:
+            st["delayed"] += 1
+            st["wait_sec"] += wait
+            st["max_wait_sec"] = max(st["max_wait_sec"], wait)
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                b.refund()  # ожидающий ушёл — его долг не должен задерживать следующих
+                raise
+
+    def refund(self, uid: int, action: str, background: bool = False):
+        b = self._buckets.get(self._key(uid, action, background))
+        if b:
+            b.refund()
+
+    def stats(self) -> Dict[str, Dict[str, dict]]:
+        out: Dict[str, Dict[str, dict]] = {}
+        for (uid, action), st in self._stats.items():
+            b = self._buckets.get((uid, action))
+            row = dict(st)
+            if b:
+                row["per_min"] = round(b.rate * 60, 2)
+                row["burst"] = b.burst
+            out.setdefault(str(uid), {})[action] = row
+        return out
+
+PRIO_INTERACTIVE, PRIO_NORMAL, PRIO_BACKGROUND = 0, 1, 2
+
+
+class _RpcSlot:
+    def __init__(self, dispatcher: "RpcDispatcher", priority: int):
+        self._d = dispatcher
+        self._prio = priority
+
+    async def __aenter__(self):
+        await self._d.acquire(self._prio)
+        return self._d
+
+    async def __aexit__(self, *exc):
+        self._d.release()
+        return False
+
+
+class RpcDispatcher:
+    """
+    Диспетчер запросов аккаунта: независимые RPC идут параллельно поверх одного
+    MTProto-соединения, но не больше max_in_flight сразу.
+    Ожидающие стоят в куче по ключу «время постановки + задержка полосы»:
+    клики (interactive) обгоняют обычные и фоновые запросы, а старение ключа не даёт
+    фону голодать. Последний слот фону не отдаётся — он всегда свободен для клика.
+    `async with acc.rpc:` — обычная полоса (совместимо с прежним lock, плагин стикеров).
+    """
+    LANE_DELAY = {PRIO_INTERACTIVE: 0.0, PRIO_NORMAL: 0.5, PRIO_BACKGROUND: 3.0}
+
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.in_flight = 0
+        self._waiters: List[Tuple[float, int, int, asyncio.Future]] = []  # (ключ, seq, полоса, future)
+        self._seq = 0
+
+    def slot(self, priority: int = PRIO_NORMAL) -> _RpcSlot:
+        return _RpcSlot(self, priority)
+
+    async def __aenter__(self):
+        await self.acquire(PRIO_NORMAL)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+        return False
+
+    def _cap(self, priority: int) -> int:
+        if priority == PRIO_BACKGROUND and self.max_in_flight > 1:
+            return self.max_in_flight - 1
+        return self.max_in_flight
+
+    async def acquire(self, priority: int = PRIO_NORMAL):
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        key = time.monotonic() + self.LANE_DELAY.get(priority, 0.0)
+        heapq.heappush(self._waiters, (key, self._seq, priority, fut))
+        self._wake()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # слот уже выдали, но задачу отменили
+            else:
+                fut.cancel()    # ленивое удаление из кучи
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self.in_flight < self.max_in_flight:
+            while self._waiters and self._waiters[0][3].done():
+                heapq.heappop(self._waiters)
+            if not self._waiters:
+                return
+            i = 0
+            if self.in_flight >= self._cap(self._waiters[0][2]):
+                # голова — фон, упёрлась в резерв: пропускаем вперёд лучший не-фоновый запрос
+                cands = [j for j, w in enumerate(self._waiters)
+                         if w[2] != PRIO_BACKGROUND and not w[3].done()]
+                if not cands:
+                    return
+                i = min(cands, key=lambda j: self._waiters[j][:2])
+            w = self._waiters[i]
+            last = self._waiters.pop()
+            if i < len(self._waiters):
+                self._waiters[i] = last
+                heapq.heapify(self._waiters)
+            self.in_flight += 1
+            w[3].set_result(None)
+
+    def busy(self) -> bool:
+        return self.in_flight > 0
+
+    def locked(self) -> bool:
+        return self.in_flight >= self.max_in_flight
+
+class RpcStats:
+    """Задержки и исходы RPC по (аккаунт, вид вызова); задержки — скользящее окно последних WINDOW."""
+    WINDOW = 200
+
+    def __init__(self):
+        self._lat: Dict[Tuple[int, str], deque] = {}
+        self._cnt: Dict[Tuple[int, str], Dict[str, int]] = {}
+
+    def record(self, uid: int, kind: str, seconds: float, outcome: str = "ok"):
+        """
+        outcome: ok / timeout / error / hedged.
+        hedged — дубль проиграл и отменён: ответ занял бы не меньше seconds, это нижняя оценка.
+        Её тоже кладём в окно задержек, иначе медленные ответы выпадают из выборки и p95 ползёт вниз.
+        """
+        key = (uid, kind)
+        cnt = self._cnt.setdefault(key, {"ok": 0, "timeout": 0, "error": 0, "hedged": 0})
+        cnt[outcome] = cnt.get(outcome, 0) + 1
+        if outcome in ("ok", "hedged"):
+            self._lat.setdefault(key, deque(maxlen=self.WINDOW)).append(seconds)
+
+    def percentile(self, q: float, *, kind: Optional[str] = None, uid: Optional[int] = None) -> Optional[float]:
+        samples = sorted(x for (u, k), d in self._lat.items()
+                         if (kind is None or k == kind) and (uid is None or u == uid) for x in d)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def stats(self) -> Dict[str, Dict[str, dict]]:
+        out: Dict[str, Dict[str, dict]] = {}
+        for (uid, kind), cnt in self._cnt.items():
+            row = dict(cnt)
+            lat = sorted(self._lat.get((uid, kind), ()))
+            if lat:
+                row["p50_sec"] = round(lat[len(lat) // 2], 3)
+                row["p95_sec"] = round(lat[min(len(lat) - 1, int(0.95 * len(lat)))], 3)
+                row["max_sec"] = round(lat[-1], 3)
+            out.setdefault(str(uid), {})[kind] = row
+        return out
+
+# =============== Загрузка файлов ===============
+class _SharedChunkReader(io.RawIOBase):
+    """Поток поверх общего memoryview: позиция своя у каждого аккаунта, байты — одни на всех."""
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view
+        self._pos = 0
+
+    def readable(self): return True
+    def seekable(self): return True
+    def tell(self): return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, min(len(self._view), base + offset))
+        return self._pos
+
+    def read(self, n=-1):
+        end = len(self._view) if n is None or n < 0 else min(len(self._view), self._pos + n)
+        chunk = bytes(self._view[self._pos:end])
+        self._pos = end
+        return chunk
+
+
+class _MappedFile:
+    """Файл, прочитанный один раз: mmap + sha256 содержимого."""
+    def __init__(self, path: str):
+        self.name = Path(path).name
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.view = memoryview(self._mm) if self._mm is not None else memoryview(b"")
+        self.size = size
+        self.digest = hashlib.sha256(self.view).hexdigest()
+
+    def reader(self) -> _SharedChunkReader:
+        return _SharedChunkReader(self.view[:])
+
+    def close(self):
+        try:
+            self.view.release()
+            if self._mm is not None:
+                self._mm.close()
+        except BufferError:
+            pass  # ещё читается загрузкой — освободит GC
+
+
+class UploadCache:
+    """
+    Загрузка «один раз — много отправок»: файл читается и хешируется один раз,
+    каждый аккаунт грузит его из общего mmap, а полученный InputFile
+    кешируется по (аккаунт, sha256) на upload_cache_ttl_sec.
+    """
+    MAX_FILES = 8
+
+    def __init__(self, ttl_sec: float):
+        self.ttl = float(ttl_sec)
+        self._files: "OrderedDict[Tuple[str, int, int], _MappedFile]" = OrderedDict()  # (path, mtime_ns, size)
+        self._handles: Dict[Tuple[int, str], Tuple[float, object]] = {}
+        self._inflight: Dict[Tuple[int, str], asyncio.Future] = {}
+
+    async def prepare(self, path: str) -> _MappedFile:
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        mf = self._files.get(key)
+        if mf is None:
+            mf = await asyncio.to_thread(_MappedFile, path)
+            self._files[key] = mf
+            while len(self._files) > self.MAX_FILES:
+                _, old = self._files.popitem(last=False)
+                old.close()
+        self._files.move_to_end(key)
+        return mf
+
+    def invalidate(self, uid: int, digest: str):
+        self._handles.pop((uid, digest), None)
+
+    async def input_file(self, uid: int, path: str, upload) -> Tuple[object, str]:
+        """upload(reader, size, name) -> InputFile; одновременные запросы одного аккаунта ждут одну загрузку."""
+        mf = await self.prepare(path)
+        key = (uid, mf.digest)
+        hit = self._handles.get(key)
+        if hit and time.time() - hit[0] < self.ttl:
+            return hit[1], mf.digest
+        fut = self._inflight.get(key)
+        if fut is not None:
+            return await asyncio.shield(fut), mf.digest
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            handle = await upload(mf.reader(), mf.size, mf.name)
+            self._handles[key] = (time.time(), handle)
+            fut.set_result(handle)
+            return handle, mf.digest
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # чтобы не было «exception was never retrieved»
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+# =============== Кеш сущностей ===============
+# после этих ошибок закешированный peer считаем протухшим
+STALE_PEER_ERRORS = (ChannelPrivateError, ChannelInvalidError, PeerIdInvalidError,
+                     ChatIdInvalidError, UsernameNotOccupiedError, UsernameInvalidError)
+
+
+class EntityCache:
+    """
+    Двухуровневый кеш резолва ref по (аккаунт, ref):
+    L1 — LRU в памяти с полными сущностями (ноль RPC);
+    L2 — на диске (тип пира, id, access_hash): из него сразу собирается InputPeer,
+    а полная сущность добирается дешёвым get_entity без ResolveUsername и перебора типов.
+    Записи живут ttl секунд; invalidate() — при ChannelPrivate/PeerIdInvalid и т.п.
+    """
+    def __init__(self, path: Path, ttl_sec: float, mem_size: int):
+        self.path = path
+        self.ttl = float(ttl_sec)
+        self.mem_size = max(1, int(mem_size))
+        self._mem: "OrderedDict[Tuple[int, str], Tuple[float, object]]" = OrderedDict()
+        self._disk: Dict[str, Dict[str, list]] = load_json(path, {})  # uid -> ref -> [тип, id, hash, ts]
+        self._prune()
+
+    def _prune(self):
+        """Выкинуть просроченные записи L2 — иначе файл растёт с каждым когда-либо открытым чатом."""
+        for uid in list(self._disk):
+            rows = self._disk[uid]
+            for ref in [r for r, row in rows.items() if not self._fresh(row[3])]:
+                del rows[ref]
+            if not rows:
+                del self._disk[uid]
+
+    def _fresh(self, ts: float) -> bool:
+        return time.time() - ts < self.ttl
+
+    def get(self, uid: int, ref: str):
+        hit = self._mem.get((uid, ref))
+        if not hit:
+            return None
+        if not self._fresh(hit[0]):
+            self._mem.pop((uid, ref), None)
+            return None
+        self._mem.move_to_end((uid, ref))
+        return hit[1]
+
+    def get_input(self, uid: int, ref: str):
+        ent = self.get(uid, ref)
+        if ent is not None:
+            try:
+                return utils.get_input_peer(ent)
+            except Exception:
+                pass
+        row = self._disk.get(str(uid), {}).get(ref)
+        if not row or not self._fresh(row[3]):
+            return None
+        kind, pid, access_hash = row[0], int(row[1]), int(row[2] or 0)
+        if kind == "user":
+            return types.InputPeerUser(pid, access_hash)
+        if kind == "channel":
+            return types.InputPeerChannel(pid, access_hash)
+        if kind == "chat":
+            return types.InputPeerChat(pid)
+        return None
+
+    def put(self, uid: int, ref: str, entity):
+        now = time.time()
+        self._mem[(uid, ref)] = (now, entity)
+        self._mem.move_to_end((uid, ref))
+        while len(self._mem) > self.mem_size:
+            self._mem.popitem(last=False)
+        try:
+            ip = utils.get_input_peer(entity)
+        except Exception:
+            return
+        if isinstance(ip, types.InputPeerUser):
+            row = ["user", ip.user_id, ip.access_hash, now]
+        elif isinstance(ip, types.InputPeerChannel):
+            row = ["channel", ip.channel_id, ip.access_hash, now]
+        elif isinstance(ip, types.InputPeerChat):
+            row = ["chat", ip.chat_id, 0, now]
+        else:
+            return
+        self._disk.setdefault(str(uid), {})[ref] = row
+        self._save()
+
+    def invalidate(self, uid: int, ref: Optional[str] = None):
+        if ref is None:
+            for key in [k for k in self._mem if k[0] == uid]:
+                self._mem.pop(key, None)
+            dropped = self._disk.pop(str(uid), None) is not None
+        else:
+            self._mem.pop((uid, ref), None)
+            dropped = self._disk.get(str(uid), {}).pop(ref, None) is not None
+        if dropped:
+            self._save()
+
+    def forget_channel(self, uid: int, channel_id: int):
+        """Убрать из L1 сущность канала (устарел left и т.п.); запись L2 остаётся — get_entity по ней дешёвый."""
+        for key, (_, ent) in list(self._mem.items()):
+            if key[0] == uid and isinstance(ent, types.Channel) and ent.id == channel_id:
+                self._mem.pop(key, None)
+
+    def _save(self):
+        self._prune()
+        state_writer.write(self.path, lambda: self._disk)
+
+def _entity_usernames(entity) -> List[str]:
+    out = [getattr(entity, "username", None)]
+    out += [getattr(u, "username", None) for u in (getattr(entity, "usernames", None) or [])]
+    return [u.lower() for u in out if u]
+
+
+class UsernameDirectory:
+    """
+    Общий для всех аккаунтов справочник username → (тип пира, id).
+    access_hash у каждого аккаунта свой, поэтому здесь только id: остальные аккаунты
+    берут сущность дешёвым путём (свой кеш/сессия + get_entity) вместо ResolveUsername.
+    """
+    def __init__(self, path: Path, ttl_sec: float):
+        self.path = path
+        self.ttl = float(ttl_sec)
+        self._data: Dict[str, list] = load_json(path, {})  # ник в нижнем регистре -> [тип, id, ts]
+        self._prune()
+
+    def _prune(self):
+        now = time.time()
+        for uname in [u for u, row in self._data.items() if now - row[2] >= self.ttl]:
+            del self._data[uname]
+
+    def _save(self):
+        self._prune()
+        state_writer.write(self.path, lambda: self._data)
+
+    def get(self, username: str) -> Optional[Tuple[str, int]]:
+        row = self._data.get(username.lower())
+        if not row or time.time() - row[2] >= self.ttl:
+            return None
+        return row[0], int(row[1])
+
+    def put(self, entity):
+        if isinstance(entity, types.User):
+            kind = "user"
+        elif isinstance(entity, types.Channel):
+            kind = "channel"
+        else:
+            return
+        now = time.time()
+        for uname in _entity_usernames(entity):
+            self._data[uname] = [kind, entity.id, now]
+        self._save()
+
+    def invalidate(self, username: str):
+        if self._data.pop(username.lower(), None) is not None:
+            self._save()
+
+
+class DiscussionCache:
+    """
+    Кеш для комментариев: (аккаунт, канал) → привязанный чат обсуждения (сущность своя у каждого
+    аккаунта) и (канал, пост) → id корня ветки в обсуждении (одинаков для всех аккаунтов).
+    «Обсуждения нет» тоже кешируется; ошибки запросов — нет.
+    """
+    MISS = object()
+
+    def __init__(self, ttl_sec: float, root_ttl_sec: float):
+        self.ttl = float(ttl_sec)
+        self.root_ttl = float(root_ttl_sec)
+        self._linked: Dict[Tuple[int, int], Tuple[float, object]] = {}
+        self._roots: Dict[Tuple[int, int], Tuple[float, int]] = {}
+
+    def get_discussion(self, uid: int, channel_id: int):
+        hit = self._linked.get((uid, channel_id))
+        if not hit or time.time() - hit[0] >= self.ttl:
+            return self.MISS
+        return hit[1]
+
+    def put_discussion(self, uid: int, channel_id: int, discussion):
+        self._linked[(uid, channel_id)] = (time.time(), discussion)
+
+    def get_root(self, channel_id: int, post_id: int) -> Optional[int]:
+        hit = self._roots.get((channel_id, post_id))
+        if not hit or time.time() - hit[0] >= self.root_ttl:
+            return None
+        return hit[1]
+
+    def put_root(self, channel_id: int, post_id: int, root_id: int):
+        self._roots[(channel_id, post_id)] = (time.time(), int(root_id))
+
+    def invalidate(self, uid: int, channel_id: Optional[int] = None):
+        for key in [k for k in self._linked if k[0] == uid and channel_id in (None, k[1])]:
+            self._linked.pop(key, None)
+
+class AuthorResolver:
+    """
+    Имена авторов по peer id для чата и комментариев: общий LRU (имена одинаковы для всех аккаунтов),
+    singleflight по id, а промахи одного аккаунта копятся BATCH_DELAY и уходят пачкой
+    users.GetUsers / channels.GetChannels (access_hash берётся из кеша сессии).
+    run — раннер запросов окна (_run_acc).
+    """
+    BATCH_DELAY = 0.05
+    BATCH_MAX = 100
+
+    def __init__(self, run, size: int = 4000):
+        self._run = run
+        self.size = size
+        self._names: "OrderedDict[int, str]" = OrderedDict()
+        self._inflight: Dict[int, asyncio.Future] = {}
+        self._pending: Dict[int, Dict[int, asyncio.Future]] = {}  # uid -> sid -> future
+        self._flushers: Dict[int, asyncio.Task] = {}
+
+    def cached(self, sid: int) -> Optional[str]:
+        name = self._names.get(sid)
+        if name is not None:
+            self._names.move_to_end(sid)
+        return name
+
+    def remember(self, sid: int, entity):
+        if sid is None or entity is None:
+            return
+        self._names[sid] = friendly_display(entity)
+        self._names.move_to_end(sid)
+        while len(self._names) > self.size:
+            self._names.popitem(last=False)
+
+    async def name(self, acc: "Account", sid: int) -> Optional[str]:
+        hit = self.cached(sid)
+        if hit is not None:
+            return hit
+        fut = self._inflight.get(sid)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self._inflight[sid] = fut
+            batch = self._pending.setdefault(acc.user_id, {})
+            batch[sid] = fut
+            if len(batch) >= self.BATCH_MAX:
+                waiting = self._flushers.pop(acc.user_id, None)
+                if waiting:
+                    waiting.cancel()
+                asyncio.create_task(self._flush(acc, 0))
+            elif acc.user_id not in self._flushers:
+                self._flushers[acc.user_id] = asyncio.create_task(self._flush(acc, self.BATCH_DELAY))
+        return await asyncio.shield(fut)  # отмена одного ждущего (смена чата) не отменяет пачку
+
+    async def _flush(self, acc: "Account", delay: float):
+        if delay:
+            await asyncio.sleep(delay)
+            if self._flushers.get(acc.user_id) is asyncio.current_task():
+                self._flushers.pop(acc.user_id, None)
+        batch = self._pending.pop(acc.user_id, {})
+        if not batch:
+            return
+        found: Dict[int, object] = {}
+        try:
+            users, channels = [], []
+            for sid in batch:
+                try:
+                    ip = acc.client.session.get_input_entity(sid)  # только локальная сессия, без сети
+                except Exception:
+                    try:  # сессия не знает access_hash — резолвим через _run_acc (лимитер, флуд, таймаут)
+                        ip = await self._run(acc, acc.client.get_input_entity(sid),
+                                             priority=PRIO_BACKGROUND, kind="get_input_entity")
+                    except Exception:
+                        continue
+                if isinstance(ip, types.InputPeerUser):
+                    users.append(types.InputUser(ip.user_id, ip.access_hash))
+                elif isinstance(ip, types.InputPeerChannel):
+                    channels.append(types.InputChannel(ip.channel_id, ip.access_hash))
+            if users:
+                res = await self._run(acc, acc.client(functions.users.GetUsersRequest(users)),
+                                      priority=PRIO_BACKGROUND, kind="get_users")
+                for u in res or []:
+                    found[utils.get_peer_id(u)] = u
+            if channels:
+                res = await self._run(acc, acc.client(functions.channels.GetChannelsRequest(channels)),
+                                      priority=PRIO_BACKGROUND, kind="get_channels")
+                for c in getattr(res, "chats", []) or []:
+                    found[utils.get_peer_id(c)] = c
+        except Exception:
+            pass
+        finally:
+            for sid, fut in batch.items():
+                ent = found.get(sid)
+                if ent is not None:
+                    self.remember(sid, ent)
+                self._inflight.pop(sid, None)
+                if not fut.done():
+                    fut.set_result(self._names.get(sid))
+
+# =============== Локальное хранилище сообщений ===============
+def _media_descriptor(media) -> Optional[dict]:
+    if not media:
+        return None
+    out = {"type": type(media).__name__}
+    obj = getattr(media, "photo", None) or getattr(media, "document", None)
+    if obj is not None:
+        out["id"] = getattr(obj, "id", None)
+        if getattr(obj, "mime_type", None):
+            out["mime"] = obj.mime_type
+        if getattr(obj, "size", None):
+            out["size"] = obj.size
+    return out
+
+def _message_signature(m) -> tuple:
+    """То, что видно в ленте: текст, правка, реакции, число комментариев, inline-кнопки."""
+    rm = getattr(m, "reply_markup", None)
+    return (getattr(m, "message", None), getattr(m, "edit_date", None),
+            tuple(map(tuple, _reaction_counts(m))), getattr(getattr(m, "replies", None), "replies", None),
+            bytes(rm) if rm is not None else None)
+
+class MessageStore:
+    """
+    Локальная копия истории: SQLite (WAL), ключ (аккаунт, peer, msg id) — id в личках у каждого аккаунта свои.
+    Хранит сам Message в TL-сериализации плюс текст, дату, отправителя, сводку реакций и описание медиа.
+    Размер ограничен: не больше per_chat последних сообщений на чат и max_rows строк всего.
+    """
+    PRUNE_EVERY = 500   # чистим не на каждую запись, а раз в столько вставок
+
+    def __init__(self, path: Path, per_chat: int, max_rows: int):
+        self.path = path
+        self.per_chat = int(per_chat)
+        self.max_rows = int(max_rows)
+        self._db: Optional[sqlite3.Connection] = None
+        self._since_prune = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(str(self.path))
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS messages (
+                account INTEGER NOT NULL, peer INTEGER NOT NULL, id INTEGER NOT NULL,
+                date INTEGER, edit_date INTEGER, sender INTEGER, text TEXT,
+                reactions TEXT, media TEXT, raw BLOB NOT NULL,
+                PRIMARY KEY (account, peer, id)) WITHOUT ROWID""")
+            db.execute("CREATE INDEX IF NOT EXISTS messages_date ON messages(date)")
+            self._db = db
+        return self._db
+
+    @staticmethod
+    def _row(account: int, peer: int, m) -> tuple:
+        date = int(m.date.timestamp()) if getattr(m, "date", None) else None
+        edit = getattr(m, "edit_date", None)
+        return (account, peer, m.id, date, int(edit.timestamp()) if edit else None,
+                getattr(m, "sender_id", None), getattr(m, "message", None) or "",
+                json.dumps(_reaction_counts(m), ensure_ascii=False),
+                json.dumps(_media_descriptor(getattr(m, "media", None)), ensure_ascii=False),
+                bytes(m))
+
+    def put(self, account: int, peer: int, msgs):
+        rows = [self._row(account, peer, m) for m in msgs if isinstance(m, (types.Message, types.MessageService))]
+        if not rows:
+            return
+        try:
+            with self._conn() as db:
+                db.executemany("INSERT OR REPLACE INTO messages VALUES (?,?,?,?,?,?,?,?,?,?)", rows)
+            self._since_prune += len(rows)
+            if self._since_prune >= self.PRUNE_EVERY:
+                self.prune()
+        except sqlite3.Error as e:
+            print(f"[STORE] {e}")
+
+    def load(self, account: int, peer: int, limit: int) -> List[types.Message]:
+        """Последние limit сообщений чата, от новых к старым."""
+        try:
+            cur = self._conn().execute(
+                "SELECT raw FROM messages WHERE account=? AND peer=? ORDER BY id DESC LIMIT ?",
+                (account, peer, int(limit)))
+            out = []
+            for (raw,) in cur.fetchall():
+                try:
+                    out.append(BinaryReader(raw).tgread_object())
+                except Exception:
+                    continue  # схема TL поменялась — запись просто пропускаем
+            return out
+        except sqlite3.Error as e:
+            print(f"[STORE] {e}")
+            return []
+
+    def delete(self, account: int, peer: int, ids):
+        ids = [(account, peer, i) for i in ids]
+        if not ids:
+            return
+        try:
+            with self._conn() as db:
+                db.executemany("DELETE FROM messages WHERE account=? AND peer=? AND id=?", ids)
+        except sqlite3.Error as e:
+            print(f"[STORE] {e}")
+
+    def prune(self):
+        """Ретеншн: в каждом чате оставляем per_chat новейших, затем режем общий объём по дате."""
+        self._since_prune = 0
+        try:
+            with self._conn() as db:
+                db.execute("""DELETE FROM messages WHERE (account, peer, id) IN (
+                    SELECT account, peer, id FROM (
+                        SELECT account, peer, id, ROW_NUMBER() OVER (PARTITION BY account, peer ORDER BY id DESC) AS rn
+                        FROM messages) WHERE rn > ?)""", (self.per_chat,))
+                (total,) = db.execute("SELECT COUNT(*) FROM messages").fetchone()
+                if total > self.max_rows:
+                    db.execute("""DELETE FROM messages WHERE (account, peer, id) IN (
+                        SELECT account, peer, id FROM messages ORDER BY date ASC LIMIT ?)""", (total - self.max_rows,))
+        except sqlite3.Error as e:
+            print(f"[STORE] {e}")
+
+    def close(self):
+        if self._db is not None:
+            try:
+                self._db.close()
+            except sqlite3.Error:
+                pass
+            self._db = None
+
 # =============== Модель ===============
 @dataclass
 class Account:
@@ -354,8 +1329,165 @@ class Account:
     user: types.User
     user_id: int
     display: str
-    api_lock: asyncio.Lock
-    last_used_ts: float = 0.0
+    last_used_ts: float = 0.0          # последняя отправка/реакция — порядок LRU (переживает рестарт)
+    active_ts: float = 0.0             # последний любой вызов через _run_acc — для усыпления, в памяти
+    session_key: str = ""              # отпечаток auth_key сессии (_session_key_hash), считается один раз
+    connected_ts: float = 0.0          # когда клиент последний раз подключили
+    connect_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    validated: bool = True          # False — личность взята из снимка, get_me ещё не подтвердил
+    degraded_until: float = 0.0     # до этого момента аккаунт/прокси считается медленным (был таймаут)
+    joined: Dict[int, bool] = field(default_factory=dict)  # channel_id -> состоит ли (False — вышел/кикнули)
+    rpc: RpcDispatcher = field(default_factory=lambda: RpcDispatcher(SETTINGS["rpc_in_flight_per_account"]))
+
+@dataclass
+class ChatHistory:
+    """
+    Окно загруженной истории чата. Страницы идут как на экране: сверху новые, снизу старые;
+    каждая страница — список сообщений от новых к старым.
+    """
+    acc: "Account"          # аккаунт просмотра (комментарии и т.п.)
+    src: "Account"          # чьими сообщениями наполнено окно — им же грузим страницы и медиа
+    entity: object
+    ref: str
+    allowed: List[str]
+    pages: deque = field(default_factory=deque)
+    has_older: bool = True
+    has_newer: bool = False
+    loading: bool = False
+
+    @property
+    def oldest_id(self) -> int:
+        return self.pages[-1][-1].id if self.pages and self.pages[-1] else 0
+
+    @property
+    def newest_id(self) -> int:
+        return self.pages[0][0].id if self.pages and self.pages[0] else 0
+
+    def messages(self) -> List[types.Message]:
+        return [m for page in self.pages for m in page]
+
+class AccountScheduler:
+    """
+    Очередь аккаунтов для отправки и реакций.
+    Готовые аккаунты идут по кругу в OrderedDict; получивший FloodWait/PeerFlood
+    уходит в кучу «остывающих» до истечения лимита и в выборку не попадает.
+    Все операции — O(1) (возврат из кучи — O(log n) на аккаунт).
+    Для режима «давно не использованный» — min-куча по last_used_ts с ленивым
+    удалением устаревших записей: touch() и выбор — O(log n).
+    """
+    def __init__(self):
+        self._ready: "OrderedDict[int, None]" = OrderedDict()
+        self._cooling: List[Tuple[float, int]] = []   # (until, uid), записи могут быть устаревшими
+        self._flood_until: Dict[int, float] = {}
+        self._last_used: Dict[int, float] = {}
+        self._lru: List[Tuple[float, int]] = []       # (last_used_ts, uid), тоже ленивая
+
+    def __contains__(self, uid: int) -> bool:
+        return uid in self._ready or uid in self._flood_until
+
+    def __len__(self) -> int:
+        return len(self._ready) + len(self._flood_until)
+
+    def add(self, uid: int, last_used: float = 0.0):
+        if uid not in self:
+            self._ready[uid] = None
+            self.touch(uid, last_used)
+
+    def remove(self, uid: int):
+        self._ready.pop(uid, None)
+        self._flood_until.pop(uid, None)
+        self._last_used.pop(uid, None)
+
+    def clear(self):
+        self._ready.clear(); self._cooling.clear(); self._flood_until.clear()
+        self._last_used.clear(); self._lru.clear()
+
+    def touch(self, uid: int, ts: float):
+        if self._last_used.get(uid) == ts:
+            return
+        self._last_used[uid] = ts
+        heapq.heappush(self._lru, (ts, uid))
+        if len(self._lru) > 4 * len(self._last_used) + 64:
+            # слишком много мусора от частых touch — пересобираем кучу
+            self._lru = [(t, u) for u, t in self._last_used.items()]
+            heapq.heapify(self._lru)
+
+    def least_recent(self, n: int = 1) -> List[int]:
+        """До n готовых (не на лимите) аккаунтов, давно не использовавшихся — первым самый старый."""
+        self._release_expired()
+        out: List[int] = []
+        held: List[Tuple[float, int]] = []
+        while self._lru and len(out) < n:
+            ts, uid = heapq.heappop(self._lru)
+            if self._last_used.get(uid) != ts:
+                continue
+            held.append((ts, uid))
+            if uid in self._ready:
+                out.append(uid)
+        for entry in held:
+            heapq.heappush(self._lru, entry)
+        return out
+
+    def mark_flood(self, uid: int, seconds: float) -> float:
+        """Убирает аккаунт из ротации на seconds; возвращает момент (monotonic) освобождения."""
+        until = time.monotonic() + max(1.0, float(seconds or 0))
+        if uid not in self:
+            return until
+        if until <= self._flood_until.get(uid, 0.0):
+            return self._flood_until[uid]
+        self._ready.pop(uid, None)
+        self._flood_until[uid] = until
+        heapq.heappush(self._cooling, (until, uid))
+        return until
+
+    def _release_expired(self):
+        now = time.monotonic()
+        while self._cooling and self._cooling[0][0] <= now:
+            until, uid = heapq.heappop(self._cooling)
+            if self._flood_until.get(uid) != until:
+                continue
+            del self._flood_until[uid]
+            self._ready[uid] = None
+
+    def cooldown_left(self, uid: int) -> float:
+        self._release_expired()
+        until = self._flood_until.get(uid)
+        return max(0.0, until - time.monotonic()) if until else 0.0
+
+    def is_cooling(self, uid: int) -> bool:
+        return self.cooldown_left(uid) > 0
+
+    def ready_ids(self) -> List[int]:
+        self._release_expired()
+        return list(self._ready)
+
+    def peek(self, n: int = 1) -> List[int]:
+        self._release_expired()
+        return list(islice(self._ready, n))
+
+    def next_eligible(self, *, advance: bool = True) -> Optional[int]:
+        """Первый готовый аккаунт; advance=True — он уходит в конец круга."""
+        self._release_expired()
+        if not self._ready:
+            return None
+        uid = next(iter(self._ready))
+        if advance:
+            self._ready.move_to_end(uid)
+        return uid
+
+    def rotate(self):
+        self.next_eligible(advance=True)
+
+    def time_until_free(self) -> Optional[float]:
+        """0 — есть готовый аккаунт; N — через сколько секунд освободится ближайший; None — аккаунтов нет."""
+        self._release_expired()
+        if self._ready:
+            return 0.0
+        while self._cooling and self._flood_until.get(self._cooling[0][1]) != self._cooling[0][0]:
+            heapq.heappop(self._cooling)
+        if not self._cooling:
+            return None
+        return max(0.0, self._cooling[0][0] - time.monotonic())
 
 # =============== Баблы/Комментарии ===============
 class MessageBubble(QFrame):
@@ -529,6 +1661,17 @@ class MessageBubble(QFrame):
             self._rx_row.insertWidget(self._rx_row.count()-1, btn)
             self._rx_pills[emoji] = (btn, delta)
 
+    def set_reactions(self, counts: List[List]):
+        """Привести плашки к точным счётчикам (из обновления сервера)."""
+        new = {e: c for e, c in counts}
+        for emo, (_, cur) in list(self._rx_pills.items()):
+            if emo not in new and cur:
+                self.apply_reaction(emo, -cur)
+        for emo, cnt in new.items():
+            cur = self._rx_pills.get(emo, (None, 0))[1]
+            if cnt != cur:
+                self.apply_reaction(emo, cnt - cur)
+
     def set_author(self, text: str):
         try:
             self.lbl_author.setText(text)
@@ -605,6 +1748,31 @@ class CommentsPanel(QWidget):
         if b:
             b.apply_reaction(emoji, delta)
 
+    def comment_bubble(self, msg_id: int) -> Optional[MessageBubble]:
+        return self._id2bubble.get(msg_id)
+
+    def replace_comment_bubble(self, msg: types.Message, outgoing: bool, emojis: List[str]) -> Optional[MessageBubble]:
+        old = self._id2bubble.get(msg.id)
+        if not old:
+            return None
+        bubble = MessageBubble(msg, outgoing, True, show_reply_btn=True, emojis=emojis, parent=self)
+        bubble.reactClicked.connect(lambda message, emoji: self.reactInComment.emit(message, emoji))
+        bubble.replyClicked.connect(lambda message=msg: self._select_reply_target(message))
+        self.inner_v.insertWidget(self.inner_v.indexOf(old), bubble)
+        old.setParent(None)
+        self._id2bubble[msg.id] = bubble
+        self._msg_map = [msg if m.id == msg.id else m for m in self._msg_map]
+        return bubble
+
+    def remove_comment_bubbles(self, ids: Set[int]):
+        for mid in ids:
+            b = self._id2bubble.pop(mid, None)
+            if b:
+                b.setParent(None)
+        self._msg_map = [m for m in self._msg_map if m.id not in ids]
+        if self._reply_target is not None and self._reply_target.id in ids:
+            self._clear_reply_target()
+
     def _select_reply_target(self, message: types.Message):
         self._reply_target = message
         author = "комментарий"
@@ -635,6 +1803,470 @@ class CommentsPanel(QWidget):
     def clear_reply_indicator(self):
         self._clear_reply_target()
 
+# =============== Лента чата (model/view) ===============
+_ROW_REV = count(1)
+
+def _reaction_counts(msg: types.Message) -> List[List]:
+    out = []
+    rx = getattr(msg, "reactions", None)
+    for rc in (getattr(rx, "results", None) or []):
+        try:
+            if isinstance(rc.reaction, types.ReactionEmoji) and rc.reaction.emoticon:
+                out.append([rc.reaction.emoticon, int(rc.count)])
+        except Exception:
+            pass
+    return out
+
+def _inline_buttons(msg: types.Message) -> List[List[Tuple[str, dict]]]:
+    rows = []
+    try:
+        rm = getattr(msg, "reply_markup", None)
+        if isinstance(rm, types.ReplyInlineMarkup) and getattr(rm, "rows", None):
+            for row in rm.rows:
+                items = []
+                for b in getattr(row, "buttons", []) or []:
+                    text = getattr(b, "text", "") or "…"
+                    if isinstance(b, types.KeyboardButtonUrl):
+                        info = {"kind": "url", "url": getattr(b, "url", "")}
+                    elif isinstance(b, types.KeyboardButtonCallback):
+                        info = {"kind": "callback", "data": getattr(b, "data", None)}
+                    elif isinstance(b, types.KeyboardButtonSwitchInline):
+                        info = {"kind": "switch_inline", "query": getattr(b, "query", "") or "",
+                                "same_peer": bool(getattr(b, "same_peer", False))}
+                    else:
+                        info = {"kind": "unknown"}
+                    items.append((text, info))
+                if items:
+                    rows.append(items)
+    except Exception:
+        pass
+    return rows
+
+@dataclass
+class ChatRow:
+    """Строка ленты: всё, что нужно делегату для отрисовки, без виджетов."""
+    msg: types.Message
+    outgoing: bool
+    can_react: bool
+    author: str
+    time: str
+    text: str
+    allowed: List[str]
+    reactions: List[List] = field(default_factory=list)      # [[emoji, count], ...]
+    buttons: List[List[Tuple[str, dict]]] = field(default_factory=list)
+    comments: Optional[int] = None      # None — кнопки «Комментарии» нет
+    has_media: bool = False
+    media_state: str = ""               # "" / "loading" / "done" (кнопка больше не нужна)
+    media_pm: Optional[QPixmap] = None
+    rev: int = field(default_factory=lambda: next(_ROW_REV))  # ключ кеша раскладки, меняется при любой правке
+
+    @classmethod
+    def from_message(cls, msg: types.Message, allowed: List[str]) -> "ChatRow":
+        outgoing = bool(msg.out)
+        can_react = True
+        try:
+            r = getattr(msg, "reactions", None)
+            if r and hasattr(r, "can_set") and r.can_set is False:
+                can_react = False
+        except Exception:
+            pass
+        author = "Сообщение"
+        try:
+            if msg.sender:
+                author = utils.get_display_name(msg.sender) or author
+            elif outgoing:
+                author = "Вы"
+        except Exception:
+            pass
+        comments = None
+        if msg.replies or isinstance(msg.peer_id, types.PeerChannel):
+            try: comments = getattr(msg.replies, "replies", 0) or 0
+            except Exception: comments = 0
+        text = msg.message or (msg.media and getattr(msg.media, 'caption', None)) or ""
+        return cls(msg=msg, outgoing=outgoing, can_react=can_react, author=author,
+                   time=msg.date.strftime("%d.%m %H:%M") if msg.date else "",
+                   text=text, allowed=allowed or [], reactions=_reaction_counts(msg),
+                   buttons=_inline_buttons(msg), comments=comments, has_media=bool(msg.media))
+
+    def touch(self):
+        self.rev = next(_ROW_REV)
+
+    def apply_reaction(self, emoji: str, delta: int = 1):
+        for pair in self.reactions:
+            if pair[0] == emoji:
+                pair[1] = max(0, pair[1] + delta)
+                return
+        if delta > 0:
+            self.reactions.append([emoji, delta])
+
+class ChatListModel(QAbstractListModel):
+    """Плоский список ChatRow сверху вниз (новые сверху). Сами страницы держит ChatHistory."""
+    RowRole = Qt.UserRole + 1
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._rows: List[ChatRow] = []
+        self._pos: Dict[int, int] = {}   # msg.id -> номер строки
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._rows):
+            return None
+        row = self._rows[index.row()]
+        if role == self.RowRole:
+            return row
+        if role == Qt.DisplayRole:
+            return row.text
+        return None
+
+    def _reindex(self):
+        self._pos = {r.msg.id: i for i, r in enumerate(self._rows)}
+
+    def rows(self) -> List[ChatRow]:
+        return list(self._rows)
+
+    def reset(self, rows: List[ChatRow]):
+        self.beginResetModel()
+        self._rows = list(rows)
+        self._reindex()
+        self.endResetModel()
+
+    def insert_rows(self, at: int, rows: List[ChatRow]):
+        if not rows:
+            return
+        self.beginInsertRows(QModelIndex(), at, at + len(rows) - 1)
+        self._rows[at:at] = rows
+        self._reindex()
+        self.endInsertRows()
+
+    def remove_ids(self, ids: Set[int]) -> List[ChatRow]:
+        """Удаляет строки с указанными id непрерывными блоками; возвращает удалённые."""
+        gone: List[ChatRow] = []
+        i = len(self._rows) - 1
+        while i >= 0:
+            if self._rows[i].msg.id not in ids:
+                i -= 1
+                continue
+            end = i
+            while i >= 0 and self._rows[i].msg.id in ids:
+                i -= 1
+            self.beginRemoveRows(QModelIndex(), i + 1, end)
+            gone[:0] = self._rows[i + 1:end + 1]
+            del self._rows[i + 1:end + 1]
+            self.endRemoveRows()
+        if gone:
+            self._reindex()
+        return gone
+
+    def replace_row(self, row: ChatRow) -> Optional[QModelIndex]:
+        """Подменяет строку с тем же msg.id (свежая версия сообщения); загруженное превью сохраняется."""
+        i = self._pos.get(row.msg.id)
+        if i is None:
+            return None
+        old = self._rows[i]
+        if old.media_pm is not None:
+            row.media_pm, row.media_state = old.media_pm, old.media_state
+        self._rows[i] = row
+        idx = self.index(i)
+        self.dataChanged.emit(idx, idx)
+        return idx
+
+    def find(self, msg_id: int) -> Optional[ChatRow]:
+        i = self._pos.get(msg_id)
+        return self._rows[i] if i is not None else None
+
+    def update(self, msg_id: int, fn) -> Optional[QModelIndex]:
+        i = self._pos.get(msg_id)
+        if i is None:
+            return None
+        fn(self._rows[i])
+        self._rows[i].touch()
+        idx = self.index(i)
+        self.dataChanged.emit(idx, idx)
+        return idx
+
+class _RowLayout:
+    __slots__ = ("height", "bubble", "author", "time", "text", "text_pos", "media", "buttons", "note", "hits")
+
+    def __init__(self):
+        self.height = 0
+        self.bubble = QRect()
+        self.author = QRect()
+        self.time = QRect()
+        self.text: Optional[QStaticText] = None
+        self.text_pos = QPoint()
+        self.media: Optional[QRect] = None
+        self.buttons: List[Tuple[QRect, str, str]] = []     # (rect, текст, стиль)
+        self.note: Optional[Tuple[QRect, str]] = None
+        self.hits: List[Tuple[QRect, str, object]] = []     # (rect, действие, данные)
+
+class ChatDelegate(QStyledItemDelegate):
+    """
+    Рисует бабл прямо на viewport — без QLabel/QPushButton на сообщение.
+    Раскладка (прямоугольники и QStaticText) кешируется по (msg.id, rev, ширина);
+    по ней же view понимает, на что кликнули.
+    """
+    PAD_X, PAD_Y, GAP = 12, 10, 8
+    SIDE_NEAR, SIDE_FAR, MARGIN_Y = 8, 120, 6
+    CACHE_MAX = 600
+
+    _STYLES = {
+        "primary": ("#2d6cdf", None, "#ffffff", 10, True),
+        "inline": ("#24325a", "#2b3a66", "#eaf2ff", 10, False),
+        "pill": ("#1a2440", "#2b3a66", "#eaf2ff", 12, False),
+    }
+
+    def __init__(self, view: QListView):
+        super().__init__(view)
+        self._view = view
+        self._cache: "OrderedDict[Tuple[int, int, int], _RowLayout]" = OrderedDict()
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def layout_for(self, row: ChatRow, width: int) -> _RowLayout:
+        key = (row.msg.id, row.rev, width)
+        lay = self._cache.get(key)
+        if lay is None:
+            lay = self._build(row, width, self._view.font())
+            self._cache[key] = lay
+            while len(self._cache) > self.CACHE_MAX:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return lay
+
+    def _build(self, row: ChatRow, width: int, font: QFont) -> _RowLayout:
+        lay = _RowLayout()
+        fm = QFontMetrics(font)
+        bold = QFont(font); bold.setBold(True)
+        bfm = QFontMetrics(bold)
+        left = self.SIDE_FAR if row.outgoing else self.SIDE_NEAR
+        right = self.SIDE_NEAR if row.outgoing else self.SIDE_FAR
+        bw = max(200, width - left - right)
+        cx = left + self.PAD_X
+        cw = bw - 2 * self.PAD_X
+        line_h = fm.height()
+        btn_h = line_h + 16
+        pill_h = line_h + 6
+
+        y = self.MARGIN_Y + self.PAD_Y
+        lay.author = QRect(cx, y, int(cw * 0.7), line_h)
+        lay.time = QRect(cx, y, cw, line_h)
+        y += line_h + self.GAP
+
+        st = QStaticText(row.text or "(медиа)")
+        st.setTextFormat(Qt.PlainText)
+        opt = QTextOption(); opt.setWrapMode(QTextOption.WrapAtWordBoundaryOrAnywhere)
+        st.setTextOption(opt)
+        st.setTextWidth(cw)
+        st.prepare(font=font)
+        lay.text = st
+        lay.text_pos = QPoint(cx, y)
+        y += int(st.size().height()) + self.GAP
+
+        def flow(items, h, style, gap):
+            # раскладывает кнопки по строкам слева направо, переносит по ширине
+            nonlocal y
+            x = cx
+            for text, kind, payload in items:
+                w = min(cw, (bfm if style == "primary" else fm).horizontalAdvance(text) + 20)
+                if x > cx and x + w > cx + cw:
+                    x = cx; y += h + gap
+                r = QRect(x, y, w, h)
+                lay.buttons.append((r, text, style))
+                if kind:
+                    lay.hits.append((r, kind, payload))
+                x += w + gap
+            y += h + self.GAP
+
+        if row.media_pm is not None and not row.media_pm.isNull():
+            pm = row.media_pm
+            w = min(pm.width(), cw)
+            h = pm.height() * w // max(1, pm.width())
+            lay.media = QRect(cx, y, w, h)
+            y += h + self.GAP
+        elif row.has_media and row.media_state != "done":
+            loading = row.media_state == "loading"
+            flow([("Загрузка…" if loading else "Показать медиа", None if loading else "media", None)],
+                 btn_h, "primary", 6)
+
+        for brow in row.buttons:
+            flow([(text, "inline", info) for text, info in brow], btn_h, "inline", 6)
+
+        if row.can_react:
+            pills = [(f"{e} {c}", "react", e) for e, c in row.reactions]
+            flow(pills or [("Добавить реакцию  ⊕", "add_reaction", None)], pill_h, "pill", 6)
+        else:
+            lay.note = (QRect(cx, y, cw, line_h), "реакции отключены")
+            y += line_h + self.GAP
+
+        actions = []
+        if row.comments is not None:
+            actions.append((f"Комментарии ({row.comments})" if row.comments else "Комментарии", "comments", None))
+        actions.append(("Ответить", "reply", None))
+        flow(actions, btn_h, "primary", 8)
+        y += self.PAD_Y - self.GAP
+
+        lay.bubble = QRect(left, self.MARGIN_Y, bw, y - self.MARGIN_Y)
+        lay.height = y + self.MARGIN_Y
+        return lay
+
+    def sizeHint(self, option, index):
+        row = index.data(ChatListModel.RowRole)
+        width = self._view.viewport().width()
+        if row is None:
+            return QSize(width, 0)
+        return QSize(width, self.layout_for(row, width).height)
+
+    def paint(self, painter: QPainter, option, index):
+        row = index.data(ChatListModel.RowRole)
+        if row is None:
+            return
+        lay = self.layout_for(row, option.rect.width())
+        font = self._view.font()
+        bold = QFont(font); bold.setBold(True)
+        painter.save()
+        try:
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.translate(option.rect.topLeft())
+
+            top, bottom, border = (("#264a8a", "#1f3b70", "#3c5da1") if row.outgoing
+                                   else ("#18243d", "#132036", "#2a3a63"))
+            b = QRectF(lay.bubble).adjusted(0.5, 0.5, -0.5, -0.5)
+            grad = QLinearGradient(b.topLeft(), b.bottomLeft())
+            grad.setColorAt(0, QColor(top)); grad.setColorAt(1, QColor(bottom))
+            path = QPainterPath(); path.addRoundedRect(b, 16, 16)
+            painter.fillPath(path, QBrush(grad))
+            painter.setPen(QPen(QColor(border), 1)); painter.drawPath(path)
+
+            painter.setFont(bold); painter.setPen(QColor("#e8eeff"))
+            painter.drawText(lay.author, Qt.AlignLeft | Qt.AlignVCenter,
+                             QFontMetrics(bold).elidedText(row.author, Qt.ElideRight, lay.author.width()))
+            painter.setFont(font); painter.setPen(QColor("#cbd5ff"))
+            painter.drawText(lay.time, Qt.AlignRight | Qt.AlignVCenter, row.time)
+            painter.setPen(QColor("#eaf2ff"))
+            painter.drawStaticText(lay.text_pos, lay.text)
+
+            if lay.media is not None and row.media_pm is not None:
+                painter.drawPixmap(lay.media, row.media_pm)
+
+            for r, text, style in lay.buttons:
+                bg, edge, fg, radius, is_bold = self._STYLES[style]
+                rf = QRectF(r).adjusted(0.5, 0.5, -0.5, -0.5)
+                painter.setPen(QPen(QColor(edge), 1) if edge else Qt.NoPen)
+                painter.setBrush(QColor(bg))
+                painter.drawRoundedRect(rf, radius, radius)
+                painter.setFont(bold if is_bold else font); painter.setPen(QColor(fg))
+                painter.drawText(r, Qt.AlignCenter,
+                                 painter.fontMetrics().elidedText(text, Qt.ElideRight, r.width() - 8))
+
+            if lay.note:
+                painter.setFont(font); painter.setPen(QColor("#9fb3d9"))
+                painter.drawText(lay.note[0], Qt.AlignLeft | Qt.AlignVCenter, lay.note[1])
+        finally:
+            painter.restore()
+
+class ChatListView(QListView):
+    """Лента чата: рисуется делегатом, на экране только видимые строки. Сигналы — как у MessageBubble."""
+    reactClicked = Signal(object, str)
+    commentsClicked = Signal(object)
+    replyClicked = Signal(object)
+    inlineButtonClicked = Signal(object, object)
+    mediaClicked = Signal(object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setObjectName("chatList")
+        self.setUniformItemSizes(False)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setResizeMode(QListView.Adjust)
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.verticalScrollBar().setSingleStep(24)
+        self.setMouseTracking(True)
+        self.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.customContextMenuRequested.connect(self._context_menu)
+        self.delegate = ChatDelegate(self)
+        self.setItemDelegate(self.delegate)
+
+    def setModel(self, model):
+        super().setModel(model)
+        model.modelReset.connect(self.delegate.clear_cache)
+
+    def row_height(self, row: ChatRow) -> int:
+        return self.delegate.layout_for(row, self.viewport().width()).height
+
+    def settle(self):
+        """Применить отложенную раскладку сейчас — чтобы поправить прокрутку после вставки строк."""
+        self.executeDelayedItemsLayout()
+
+    def refresh(self, index: Optional[QModelIndex]):
+        # высота строки могла измениться — просим view переложить
+        if index is not None and index.isValid():
+            self.delegate.sizeHintChanged.emit(index)
+
+    def _hit(self, pos):
+        idx = self.indexAt(pos)
+        if not idx.isValid():
+            return None
+        row = idx.data(ChatListModel.RowRole)
+        rect = self.visualRect(idx)
+        local = pos - rect.topLeft()
+        for r, kind, payload in self.delegate.layout_for(row, rect.width()).hits:
+            if r.contains(local):
+                return row, kind, payload
+        return None
+
+    def mouseMoveEvent(self, e):
+        hit = self._hit(e.position().toPoint())
+        self.viewport().setCursor(Qt.PointingHandCursor if hit else Qt.ArrowCursor)
+        super().mouseMoveEvent(e)
+
+    def mouseReleaseEvent(self, e):
+        if e.button() == Qt.LeftButton:
+            hit = self._hit(e.position().toPoint())
+            if hit:
+                self._dispatch(*hit, e.globalPosition().toPoint())
+                return
+        super().mouseReleaseEvent(e)
+
+    def _dispatch(self, row: ChatRow, kind: str, payload, global_pos):
+        msg = row.msg
+        if kind == "react":
+            self.reactClicked.emit(msg, payload)
+        elif kind == "add_reaction":
+            if not row.allowed:
+                return
+            menu = QMenu(self)
+            for emo in row.allowed:
+                act = menu.addAction(emo)
+                act.triggered.connect(lambda _, e=emo: self.reactClicked.emit(msg, e))
+            menu.exec(global_pos)
+        elif kind == "inline":
+            self.inlineButtonClicked.emit(msg, payload)
+        elif kind == "media":
+            self.mediaClicked.emit(msg)
+        elif kind == "comments":
+            self.commentsClicked.emit(msg)
+        elif kind == "reply":
+            self.replyClicked.emit(msg)
+
+    def _context_menu(self, pos):
+        idx = self.indexAt(pos)
+        if not idx.isValid():
+            return
+        row = idx.data(ChatListModel.RowRole)
+        menu = QMenu(self)
+        act = menu.addAction("Копировать текст")
+        act.setEnabled(bool(row.text))
+        act.triggered.connect(lambda: QGuiApplication.clipboard().setText(row.text))
+        menu.addAction("Ответить").triggered.connect(lambda: self.replyClicked.emit(row.msg))
+        menu.exec(self.viewport().mapToGlobal(pos))
+
 # =============== Главное окно ===============
 class MainWindow(QMainWindow):
     _IMG_EXT = (".png",".jpg",".jpeg",".webp",".gif",".bmp")
@@ -646,8 +2278,11 @@ class MainWindow(QMainWindow):
         self.resize(1480, 940)
         self.accounts: Dict[int, Account] = {}
         self.pins: List[str] = load_pins()      # ГЛОБАЛЬНЫЙ список
-        self.rr_order: List[int] = []
-        self._rr_pointer = 0
+        self.scheduler = AccountScheduler()
+        self._cached_last_used: Dict[int, float] = {}
+        self.rate_limiter = RateLimiter(SETTINGS["rate_limits"])
+        self.rpc_stats = RpcStats()
+        self.upload_cache = UploadCache(SETTINGS["upload_cache_ttl_sec"])
         self._uid_to_item: Dict[int, QListWidgetItem] = {}
 
         # память реакций
@@ -666,16 +2301,37 @@ class MainWindow(QMainWindow):
         self._comments_ctx_post_id: Optional[int] = None
         self._comments_ctx_root_discussion_id: Optional[int] = None
         self._comments_ctx_acc: Optional[Account] = None
+        self._comments_ctx_discussion_id: Optional[int] = None   # peer id чата обсуждения (для живых обновлений)
+        self._comments_ctx_allowed: List[str] = []
         self._comments_pending_file_path: Optional[str] = None
 
-        # live обновление комментов
-        self._comments_timer = QTimer(self)
-        self._comments_timer.setInterval(2500)
-        self._comments_timer.timeout.connect(lambda: asyncio.create_task(self._refresh_comments_tick()))
+        # комментарии обновляются событиями клиента (см. _install_account_handlers)
         self._comments_known_ids: set[int] = set()
 
         # кеш InputPeer
-        self._peer_cache: Dict[Tuple[int, str], object] = {}  # (uid, ref) -> InputPeer
+        self.discussion_cache = DiscussionCache(SETTINGS["discussion_cache_ttl_sec"],
+                                                SETTINGS["discussion_root_ttl_sec"])
+        self.author_resolver = AuthorResolver(self._run_acc)
+        self.username_dir = UsernameDirectory(USERNAMES_FILE, SETTINGS["username_dir_ttl_sec"])
+        self.entity_cache = EntityCache(ENTITY_CACHE_FILE, SETTINGS["entity_cache_ttl_sec"],
+                                        SETTINGS["entity_cache_mem_size"])
+        self.message_store = MessageStore(MESSAGES_DB_FILE, SETTINGS["message_store_per_chat"],
+                                          SETTINGS["message_store_max_rows"])
+        atexit.register(self.message_store.close)
+
+        # усыпление простаивающих аккаунтов
+        self._hibernate_timer = QTimer(self)
+        self._hibernate_timer.setInterval(30_000)
+        self._hibernate_timer.timeout.connect(self._hibernate_idle_tick)
+        self._hibernate_timer.start()
+
+        # last_used_ts меняется на каждой отправке — кэш аккаунтов пишем пачкой
+        self._accounts_cache_dirty = False
+        self._accounts_cache_timer = QTimer(self)
+        self._accounts_cache_timer.setInterval(30_000)
+        self._accounts_cache_timer.timeout.connect(self._flush_accounts_cache)
+        self._accounts_cache_timer.start()
+        atexit.register(self._flush_accounts_cache)  # до state_writer.flush: atexit идёт в обратном порядке
 
         self._init_ui()
         self._apply_style()
@@ -687,6 +2343,10 @@ class MainWindow(QMainWindow):
         QTimer.singleShot(0, lambda: asyncio.create_task(self._startup_boot()))
 
         self._last_loaded_messages: List[types.Message] = []
+        # поколение показанного чата: при смене отменяем всё, что грузилось для прежнего
+        self._chat_gen = 0
+        self._chat_tasks: Set[asyncio.Task] = set()
+        self._history: Optional[ChatHistory] = None
         self._reply_kb = None
         self._reply_kb_sig = None
 
@@ -700,6 +2360,7 @@ class MainWindow(QMainWindow):
         # держим ссылки на открытые модальные окна, чтобы GC их не прибил
         self._phone_login_dialog: Optional[PhoneLoginDialog] = None
         self._qr_login_dialog: Optional[QRLoginDialog] = None
+        self._broadcast_dialog: Optional[BroadcastDialog] = None
 
     # ----- message boxes -----
     async def _mb_info(self, title, text): await asyncio.sleep(0); QMessageBox.information(self, title, text)
@@ -733,18 +2394,102 @@ class MainWindow(QMainWindow):
             return True, ""
 
     # ----- Единый раннер Telethon -----
-    async def _run_acc(self, acc: Account, coro):
+    @staticmethod
+    def _rpc_budget(priority: int, timeout: Optional[float]) -> Optional[float]:
+        if timeout is None:
+            lane = {PRIO_INTERACTIVE: "interactive", PRIO_BACKGROUND: "background"}.get(priority, "normal")
+            timeout = (SETTINGS.get("rpc_timeout_sec") or {}).get(lane)
+        return float(timeout) if timeout else None
+
+    @staticmethod
+    async def _await_in_slot(acc: Account, coro, priority: int):
+        async with acc.rpc.slot(priority):
+            return await coro
+
+    async def _run_acc(self, acc: Account, coro, *, action: Optional[str] = None,
+                       priority: Optional[int] = None, timeout: Optional[float] = None,
+                       kind: Optional[str] = None, ref: Optional[str] = None):
+        """
+        action — класс для лимитера (send/react/join/resolve); без него вызов не дозируется.
+        priority — полоса диспетчера; по умолчанию send/react/join — interactive, остальное — normal.
+        timeout — бюджет на очередь диспетчера + сам вызов (None — по полосе из rpc_timeout_sec, 0 — без срока);
+        по истечении вызов отменяется, слот освобождается, аккаунт помечается медленным.
+        kind — имя вызова для статистики задержек.
+        ref — ссылка на чат запроса: при ChannelPrivate/PeerIdInvalid и т.п. её запись в кеше сущностей сбрасывается.
+        """
+        if priority is None:
+            priority = PRIO_INTERACTIVE if action in ("send", "react", "join") else PRIO_NORMAL
+        kind = kind or action or getattr(coro, "__name__", "rpc").replace("__call__", "request")
+        budget = self._rpc_budget(priority, timeout)
+        started = time.monotonic()
+        try:
+            # пробуждение спящего аккаунта — в том же бюджете: мёртвый прокси не должен вешать вызов
+            await asyncio.wait_for(self._ensure_connected(acc), budget)
+        except asyncio.TimeoutError:
+            coro.close()
+            self.rpc_stats.record(acc.user_id, "connect", time.monotonic() - started, "timeout")
+            self._mark_degraded(acc, "connect", budget or 0)
+            raise
+        except BaseException:
+            coro.close()
+            raise
+        try:
+            if action:
+                # ожидание лимитера — наш собственный темп, а не задержка сети; в бюджет не входит
+                await self.rate_limiter.acquire(acc.user_id, action, background=priority == PRIO_BACKGROUND)
+        except BaseException:
+            coro.close()
+            raise
+        acc.active_ts = time.time()
+        if action in ("send", "react"):
+            # фоновые чтения, get_me при сверке и т.п. не должны сбивать порядок LRU
+            self._touch_account(acc)
+        if budget is not None:
+            budget = max(1.0, budget - (time.monotonic() - started))
+        started = time.monotonic()
         tries = 0
         while True:
             try:
-                async with acc.api_lock:
-                    return await coro
+                res = await asyncio.wait_for(self._await_in_slot(acc, coro, priority), budget)
+                self.rpc_stats.record(acc.user_id, kind, time.monotonic() - started)
+                if acc.degraded_until and time.time() >= acc.degraded_until:
+                    self._clear_degraded(acc)
+                return res
+            except asyncio.CancelledError:
+                if action:
+                    self.rate_limiter.refund(acc.user_id, action, background=priority == PRIO_BACKGROUND)
+                raise
+            except asyncio.TimeoutError:
+                self.rpc_stats.record(acc.user_id, kind, time.monotonic() - started, "timeout")
+                self._mark_degraded(acc, kind, budget or 0)
+                if action:
+                    self.rate_limiter.refund(acc.user_id, action, background=priority == PRIO_BACKGROUND)
+                raise
             except (UserDeactivatedBanError, UserDeactivatedError,
                     SessionRevokedError, AuthKeyUnregisteredError) as e:
                 await self._kill_account(acc, f"Недоступен: {e.__class__.__name__}")
                 raise
             except (PeerFloodError, FloodWaitError) as e:
-                self._mark_account_item(acc.user_id, "#e3b341", "PeerFlood/FloodWait: временный лимит.")
+                if isinstance(e, FloodWaitError):
+                    secs = float(getattr(e, "seconds", 0) or 0)
+                else:
+                    secs = float(SETTINGS.get("peer_flood_cooldown_sec") or 0)
+                self.scheduler.mark_flood(acc.user_id, secs)
+                self._mark_account_item(acc.user_id, "#e3b341",
+                                        f"PeerFlood/FloodWait: временный лимит, отдых {int(secs)} с.")
+                QTimer.singleShot(int(secs * 1000) + 200, lambda uid=acc.user_id: self._on_flood_expired(uid))
+                self._update_labels()
+                raise
+            except STALE_PEER_ERRORS:
+                if ref:
+                    self._forget_membership(acc, ref)
+                    self.entity_cache.invalidate(acc.user_id, ref)
+                self.rpc_stats.record(acc.user_id, kind, time.monotonic() - started, "error")
+                raise
+            except (ChatWriteForbiddenError, UserBannedInChannelError):
+                if ref:
+                    self._forget_membership(acc, ref)
+                self.rpc_stats.record(acc.user_id, kind, time.monotonic() - started, "error")
                 raise
             except Exception as e:
                 if self._is_frozen_error(e):
@@ -755,19 +2500,199 @@ class MainWindow(QMainWindow):
                     tries += 1
                     await asyncio.sleep(0.15 * tries)
                     continue
+                self.rpc_stats.record(acc.user_id, kind, time.monotonic() - started, "error")
                 raise
 
+    def _forget_membership(self, acc: Account, ref: str):
+        """Нас, похоже, выкинули из канала ref: следующий _ensure_join спросит сервер заново."""
+        ip = self.entity_cache.get_input(acc.user_id, ref)
+        cid = ip.channel_id if isinstance(ip, types.InputPeerChannel) else None
+        if cid is None and ref.startswith("channel:"):
+            try: cid = int(ref.split(":", 1)[1])
+            except ValueError: pass
+        if cid is not None:
+            acc.joined.pop(cid, None)
+            self.entity_cache.forget_channel(acc.user_id, cid)
+
+    def _mark_degraded(self, acc: Account, kind: str, budget: float):
+        acc.degraded_until = time.time() + float(SETTINGS.get("degraded_cooldown_sec") or 0)
+        if self.scheduler.is_cooling(acc.user_id):
+            return  # жёлтая метка лимита важнее
+        idx = self._session_proxy_idx(acc.session_path)
+        via = f" (прокси #{idx + 1})" if idx is not None else ""
+        self._mark_account_item(acc.user_id, "#e39b41",
+                                f"Таймаут {kind} за {budget:.0f} с{via}: аккаунт временно помечен медленным.")
+
+    def _clear_degraded(self, acc: Account):
+        acc.degraded_until = 0.0
+        if not self.scheduler.is_cooling(acc.user_id):
+            self._mark_account_item(acc.user_id, "#eaf2ff", "")
+
+    def _is_degraded(self, acc: Account) -> bool:
+        return acc.degraded_until > time.time()
+
+    # ----- Подстраховка чтений вторым аккаунтом -----
+    def _hedge_delay(self, kind: str) -> float:
+        p95 = self.rpc_stats.percentile(0.95, kind=kind)
+        if p95 is None:
+            return float(SETTINGS.get("hedge_default_delay_sec") or 1.5)
+        return max(float(SETTINGS.get("hedge_min_delay_sec") or 0), p95)
+
+    def _pick_hedge_account(self, exclude: int, kind: str) -> Optional[Account]:
+        """Здоровый подключённый аккаунт с наименьшим p95 для этого вида запроса."""
+        best, best_p95 = None, None
+        for uid, acc in self.accounts.items():
+            if uid == exclude or self.scheduler.is_cooling(uid) or self._is_degraded(acc):
+                continue
+            if not acc.client.is_connected() or acc.rpc.locked():
+                continue
+            p95 = self.rpc_stats.percentile(0.95, kind=kind, uid=uid)
+            p95 = float("inf") if p95 is None else p95
+            if best is None or p95 < best_p95:
+                best, best_p95 = acc, p95
+        return best
+
+    async def _hedged_read(self, acc: Account, peer, ref: Optional[str], make, *, kind: str):
+        """
+        Чтение с подстраховкой: make(acc, peer) -> корутина запроса.
+        Если основной аккаунт не ответил за p95-задержку, тот же запрос уходит второму
+        здоровому аккаунту (peer резолвится у него по ref); побеждает первый ответ.
+        Возвращает (результат, ответивший аккаунт) — медиа из ответа грузить тем же аккаунтом.
+        Дублируем только каналы: в личках и обычных группах у второго аккаунта своя копия с другими id.
+        """
+        if (not SETTINGS.get("hedged_reads") or not ref or len(self.accounts) < 2
+                or not isinstance(peer, types.Channel)):
+            return await self._run_acc(acc, make(acc, peer), kind=kind, ref=ref), acc
+        t0 = time.monotonic()
+        first = asyncio.create_task(self._run_acc(acc, make(acc, peer), kind=kind, ref=ref))
+        try:
+            done, _ = await asyncio.wait({first}, timeout=self._hedge_delay(kind))
+        except asyncio.CancelledError:
+            first.cancel()
+            raise
+        if done:
+            return first.result(), acc
+        backup = self._pick_hedge_account(acc.user_id, kind)
+        if not backup:
+            return await first, acc
+
+        async def _second():
+            bpeer = await self._resolve_ref(backup, ref)
+            if not bpeer:
+                raise LookupError(f"{ref} недоступен для {backup.user_id}")
+            return await self._run_acc(backup, make(backup, bpeer), kind=kind, ref=ref)
+
+        second = asyncio.create_task(_second())
+        pending = {first: acc, second: backup}
+        started = {first: t0, second: time.monotonic()}
+        errors: Dict[int, BaseException] = {}
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    who = pending.pop(t)
+                    if t.exception() is None:
+                        return t.result(), who
+                    errors[who.user_id] = t.exception()
+        finally:
+            for other, who in pending.items():  # проигравший дубль и отмена снаружи (смена чата)
+                other.cancel()
+                self.rpc_stats.record(who.user_id, kind, time.monotonic() - started[other], "hedged")
+        raise errors.get(acc.user_id) or next(iter(errors.values()))
+
+    def _on_flood_expired(self, uid: int):
+        if uid in self.accounts and not self.scheduler.is_cooling(uid):
+            self._mark_account_item(uid, "#eaf2ff", "")
+            self._update_labels()
+
+    async def _on_show_rate_stats(self):
+        stats = self.rate_limiter.stats()
+        save_json(RATE_STATS_FILE, stats)
+        lines = []
+        for uid, per_action in stats.items():
+            acc = self.accounts.get(int(uid))
+            lines.append(f"{self._acc_human(acc) if acc else uid}:")
+            for action, st in sorted(per_action.items()):
+                lines.append(f"   {action}: вызовов {st['calls']}, ждали {st['delayed']} раз, "
+                             f"всего {st['wait_sec']:.1f} с (макс {st['max_wait_sec']:.1f} с)")
+        text = "\n".join(lines) or "Запросов пока не было."
+        await self._mb_info("Лимиты", f"{text}\n\nВыгружено в {RATE_STATS_FILE.name}")
+
+    async def _on_show_rpc_stats(self):
+        stats = self.rpc_stats.stats()
+        save_json(RPC_STATS_FILE, stats)
+        lines = []
+        for uid, per_kind in stats.items():
+            acc = self.accounts.get(int(uid))
+            lines.append(f"{self._acc_human(acc) if acc else uid}:")
+            for kind, st in sorted(per_kind.items()):
+                lat = f", p50 {st['p50_sec']:.2f} с, p95 {st['p95_sec']:.2f} с" if "p95_sec" in st else ""
+                lines.append(f"   {kind}: ok {st['ok']}, таймаутов {st['timeout']}, ошибок {st['error']}, "
+                             f"отменённых дублей {st.get('hedged', 0)}{lat}")
+        text = "\n".join(lines) or "Запросов пока не было."
+        await self._mb_info("Запросы", f"{text}\n\nВыгружено в {RPC_STATS_FILE.name}")
+
+    def _touch_account(self, acc: Account):
+        acc.last_used_ts = time.time()
+        self.scheduler.touch(acc.user_id, acc.last_used_ts)
+        self._accounts_cache_dirty = True  # запишет _flush_accounts_cache раз в интервал, не на каждый RPC
+
+    # ----- Спящие аккаунты -----
+    async def _ensure_connected(self, acc: Account):
+        """Будит спящий аккаунт (коннект по требованию)."""
+        if acc.client.is_connected():
+            return
+        async with acc.connect_lock:
+            if acc.client.is_connected():
+                return
+            await acc.client.connect()
+            acc.connected_ts = time.time()
+            self._mark_account_item(acc.user_id, "#eaf2ff", "")
+        if not acc.validated:
+            asyncio.create_task(self._revalidate_account(acc))
+
+    def _hibernate_idle_tick(self):
+        if not SETTINGS.get("hibernate_accounts"):
+            return
+        idle = float(SETTINGS.get("hibernate_idle_sec") or 0)
+        if idle <= 0:
+            return
+        now = time.time()
+        busy = {self.current_view_account_id}
+        if self._comments_ctx_acc:
+            busy.add(self._comments_ctx_acc.user_id)
+        for acc in list(self.accounts.values()):
+            if acc.user_id in busy or acc.rpc.busy() or acc.connect_lock.locked():
+                continue
+            if not acc.client.is_connected() or now - max(acc.last_used_ts, acc.connected_ts, acc.active_ts) < idle:
+                continue
+            asyncio.create_task(self._hibernate_account(acc))
+
+    async def _hibernate_account(self, acc: Account):
+        try:
+            await acc.client.disconnect()
+        except Exception:
+            return
+        self._mark_account_item(acc.user_id, "#9fb3d9", "Спит — подключится при использовании")
+        # снимок привязан к auth_key, а он от отключения не меняется — кэш не трогаем
+
     async def _kill_account(self, acc: Account, reason: str):
         try: await acc.client.disconnect()
         except: pass
         try: acc.session_path.unlink(missing_ok=True)
         except: pass
+        self._forget_account(acc)
+        await self._mb_warn("Аккаунт удалён", f"{friendly_display(acc.user)} ({acc.user_id}): {reason}")
+        self._save_accounts_cache()
+        self._update_labels()
+
+    def _forget_account(self, acc: Account):
+        """Убирает аккаунт из памяти и UI (файл сессии не трогает)."""
+        if self.accounts.get(acc.user_id) is not acc:
+            return
         self.accounts.pop(acc.user_id, None)
-        if acc.user_id in self.rr_order:
-            i = self.rr_order.index(acc.user_id)
-            self.rr_order.remove(acc.user_id)
-            if i <= self._rr_pointer and self._rr_pointer > 0:
-                self._rr_pointer -= 1
+        self.scheduler.remove(acc.user_id)
+        self.entity_cache.invalidate(acc.user_id)
         it = self._uid_to_item.pop(acc.user_id, None)
         if it:
             row = self.acc_list.row(it)
@@ -776,9 +2701,6 @@ class MainWindow(QMainWindow):
         if self.current_view_account_id == acc.user_id:
             self.current_view_account_id = None
             self._clear_chat_area(); self.chat_title.setText("Выберите чат")
-        await self._mb_warn("Аккаунт удалён", f"{friendly_display(acc.user)} ({acc.user_id}): {reason}")
-        self._save_accounts_cache()
-        self._update_labels()
 
     # ----- UI -----
     def _acc_human(self, acc: Optional[Account]) -> str:
@@ -829,6 +2751,22 @@ class MainWindow(QMainWindow):
         act_reload = QAction("Переподхват сессий", self)
         m_srv.addAction(act_reload)
         act_reload.triggered.connect(lambda: asyncio.create_task(self._auto_load_sessions(force=True)))
+        act_hibernate = QAction("Спящий режим аккаунтов", self)
+        act_hibernate.setCheckable(True)
+        act_hibernate.setChecked(bool(SETTINGS.get("hibernate_accounts")))
+        act_hibernate.toggled.connect(lambda on: save_setting("hibernate_accounts", bool(on)))
+        m_srv.addAction(act_hibernate)
+        act_hedge = QAction("Подстраховка чтений вторым аккаунтом", self)
+        act_hedge.setCheckable(True)
+        act_hedge.setChecked(bool(SETTINGS.get("hedged_reads")))
+        act_hedge.toggled.connect(lambda on: save_setting("hedged_reads", bool(on)))
+        m_srv.addAction(act_hedge)
+        act_rate_stats = QAction("Статистика лимитов", self)
+        act_rate_stats.triggered.connect(lambda: asyncio.create_task(self._on_show_rate_stats()))
+        m_srv.addAction(act_rate_stats)
+        act_rpc_stats = QAction("Статистика запросов", self)
+        act_rpc_stats.triggered.connect(lambda: asyncio.create_task(self._on_show_rpc_stats()))
+        m_srv.addAction(act_rpc_stats)
 
         splitter = QSplitter(Qt.Horizontal, self)
         self.setCentralWidget(splitter)
@@ -883,12 +2821,16 @@ class MainWindow(QMainWindow):
         media_opts.addStretch(1)
         cv.addLayout(media_opts)
 
-        self.chat_area = QScrollArea(self); self.chat_area.setWidgetResizable(True)
-        self.chat_inner = QWidget(self.chat_area)
-        self.chat_v = QVBoxLayout(self.chat_inner); self.chat_v.setContentsMargins(0,0,0,0); self.chat_v.setSpacing(8)
-        self.chat_v.addStretch(1)
-        self.chat_area.setWidget(self.chat_inner)
-        cv.addWidget(self.chat_area, 1)
+        self.chat_model = ChatListModel(self)
+        self.chat_view = ChatListView(self)
+        self.chat_view.setModel(self.chat_model)
+        self.chat_view.reactClicked.connect(lambda message, emoji: asyncio.create_task(self._on_react_in_chat(message, emoji)))
+        self.chat_view.commentsClicked.connect(self._on_chat_comments_clicked)
+        self.chat_view.inlineButtonClicked.connect(lambda message, info: asyncio.create_task(self._on_inline_button(message, info)))
+        self.chat_view.replyClicked.connect(self._select_main_reply_target)
+        self.chat_view.mediaClicked.connect(self._on_chat_media_clicked)
+        self.chat_view.verticalScrollBar().valueChanged.connect(self._on_chat_scrolled)
+        cv.addWidget(self.chat_view, 1)
 
         reply_bar = QHBoxLayout()
         self.reply_info_main = QLabel("", self)
@@ -916,7 +2858,7 @@ class MainWindow(QMainWindow):
 
         mode_row = QHBoxLayout()
         self.cb_auto = QCheckBox("Автоотправка с разных аккаунтов", self)
-        self.mode = QComboBox(self); self.mode.addItems(["Поочерёдно", "Рандомно", "Ручной"])
+        self.mode = QComboBox(self); self.mode.addItems(["Поочерёдно", "Рандомно", "Ручной", "Давно не использованный"])
         self.manual_acc = QComboBox(self); self._rebuild_manual_acc_combo()
         self.cb_switch_after_reaction = QCheckBox("Переключать аккаунт после реакции", self)
         self.cb_switch_after_reaction.setChecked(True)
@@ -957,7 +2899,10 @@ class MainWindow(QMainWindow):
         self.input.returnPressed.connect(lambda: asyncio.create_task(self._on_send()))
         self.btn_send.clicked.connect(lambda: asyncio.create_task(self._on_send()))
         self.btn_attach.clicked.connect(lambda: asyncio.create_task(self._on_attach()))
+        self.btn_broadcast = QPushButton("Разослать…", self)
+        self.btn_broadcast.clicked.connect(lambda: asyncio.create_task(self._on_broadcast()))
         send_row.addWidget(self.input, 1); send_row.addWidget(self.btn_attach); send_row.addWidget(self.btn_send)
+        send_row.addWidget(self.btn_broadcast)
         cv.addLayout(send_row)
 
         splitter.addWidget(center)
@@ -991,6 +2936,7 @@ class MainWindow(QMainWindow):
         QMenu::item:selected { background:#1a2440; }
         QLineEdit { padding: 8px 10px; color:#ffffff; background:#121a2b; }
         QScrollArea QWidget { background: transparent; }
+        QListView#chatList { background: #121a2b; border: 1px solid #273356; border-radius: 10px; }
         QPushButton {
             background: #2d6cdf; color: #ffffff; border: none; border-radius: 10px; padding: 8px 12px; font-weight: 600;
         }
@@ -1031,6 +2977,14 @@ class MainWindow(QMainWindow):
         return load_json(ACCOUNTS_CACHE_FILE, [])
 
     def _save_accounts_cache(self):
+        self._accounts_cache_dirty = False
+        state_writer.write(ACCOUNTS_CACHE_FILE, self._accounts_cache_payload)
+
+    def _flush_accounts_cache(self):
+        if self._accounts_cache_dirty:
+            self._save_accounts_cache()
+
+    def _accounts_cache_payload(self) -> list:
         data = []
         for uid, acc in self.accounts.items():
             u = acc.user
@@ -1041,8 +2995,30 @@ class MainWindow(QMainWindow):
                 "first_name": (u.first_name if u else None),
                 "last_name": (u.last_name if u else None),
                 "session": acc.session_path.name,
+                "session_key": self._session_key(acc),
+                "last_used_ts": acc.last_used_ts,
             })
-        save_json(ACCOUNTS_CACHE_FILE, data)
+        return data
+
+    @staticmethod
+    def _session_key(acc: Account) -> str:
+        # auth_key у живого аккаунта не меняется — читаем файл сессии один раз
+        if not acc.session_key:
+            acc.session_key = _session_key_hash(acc.session_path)
+        return acc.session_key
+
+    def _identity_snapshots(self) -> Dict[str, dict]:
+        """Снимки личности из кэша: session -> запись, только если в файле сессии тот же auth_key."""
+        out: Dict[str, dict] = {}
+        for it in self._load_accounts_cache():
+            name = it.get("session") or ""
+            try:
+                int(it.get("user_id")); key = str(it.get("session_key") or "")
+            except Exception:
+                continue
+            if key and _session_key_hash(SESS_DIR / name) == key:
+                out[name] = it
+        return out
 
     def _prepopulate_accounts_from_cache(self):
         cache = self._load_accounts_cache()
@@ -1067,73 +3043,223 @@ class MainWindow(QMainWindow):
             for acc in list(self.accounts.values()):
                 try: await acc.client.disconnect()
                 except Exception: pass
-            self.accounts.clear(); self.acc_list.clear(); self.rr_order.clear()
-            self._rr_pointer = 0
+            self.accounts.clear(); self.acc_list.clear(); self.scheduler.clear()
             self._uid_to_item.clear()
 
         files = sorted(SESS_DIR.glob("*.session"))
         seen_user_ids = set()
-        for f in files:
+        snapshots = self._identity_snapshots()
+        self._cached_last_used = {}
+        for it in self._load_accounts_cache():
             try:
-                proxy_tuple = None
-                sess_key = f.name
-                idx = self.proxies_cfg.get("assignments_by_session", {}).get(sess_key, None)
-                if idx is not None:
-                    pool = self.proxies_cfg.get("pool", [])
-                    if 0 <= idx < len(pool):
-                        proxy_tuple = _telethon_proxy_tuple_from_cfg(pool[idx])
-
-                client = TelegramClient(str(f), API_ID, API_HASH, proxy=proxy_tuple)
-                await client.connect()
-                me = await client.get_me()
-                if not me:
-                    await client.disconnect(); continue
-
-                ok, reason = await self._probe_account_health(client)
-                if not ok:
-                    try: await client.disconnect()
-                    except: pass
-                    try: f.unlink(missing_ok=True)
-                    except: pass
-                    print(f"[СЕССИЯ] Удалена сессия {f.name}: {reason}")
-                    continue
+                self._cached_last_used[int(it.get("user_id"))] = float(it.get("last_used_ts") or 0.0)
+            except Exception:
+                continue
+        if SETTINGS.get("hibernate_accounts"):
+            files = self._restore_hibernated_accounts(files, snapshots, seen_user_ids)
+        sem = asyncio.Semaphore(max(1, int(SETTINGS.get("boot_concurrency") or 1)))
+        timeout = float(SETTINGS.get("boot_session_timeout") or 0) or None
 
-                uid = me.id
-                if idx is not None:
-                    self.proxies_cfg.setdefault("assignments_by_user", {})[str(uid)] = idx
-                    _save_proxies_config(self.proxies_cfg)
+        async def _boot_guarded(f: Path):
+            async with sem:
+                try:
+                    await asyncio.wait_for(self._boot_session(f, seen_user_ids, snapshots.get(f.name)), timeout)
+                except asyncio.TimeoutError:
+                    print(f"[СЕССИЯ] Таймаут подключения {f.name} ({timeout:.0f} с)")
+                except Exception as e:
+                    print(f"[СЕССИЯ] Не удалось подхватить {f.name}: {e}")
+
+        # сессии поднимаются параллельно (не больше boot_concurrency за раз),
+        # список аккаунтов заполняется по мере готовности;
+        # прокси/кэш аккаунтов пишутся на диск один раз — по окончании загрузки
+        with state_writer.batch():
+            await asyncio.gather(*(_boot_guarded(f) for f in files))
+            self._save_accounts_cache()
 
-                if uid in seen_user_ids:
-                    await client.disconnect()
-                    try: f.unlink(missing_ok=True)
-                    except: pass
-                    continue
-                seen_user_ids.add(uid)
-                acc = Account(
-                    session_path=f,
-                    client=client,
-                    user=me,
-                    user_id=uid,
-                    display=friendly_display(me),
-                    api_lock=asyncio.Lock()
-                )
-                self.accounts[uid] = acc
-                if uid not in self.rr_order:
-                    self.rr_order.append(uid)
-                self._add_account_to_ui(acc)
+        self._rebuild_manual_acc_combo()
+        self._update_labels()
 
-                tip = []
-                if idx is not None:
-                    pr = self.proxies_cfg["pool"][idx]
-                    tip.append(f"Прокси: {pr.get('scheme')}://{pr.get('host')}:{pr.get('port')}")
-                self._mark_account_item(uid, "#a0e6a0", " | ".join(tip))
+    def _session_proxy_idx(self, f: Path) -> Optional[int]:
+        idx = self.proxies_cfg.get("assignments_by_session", {}).get(f.name, None)
+        pool = self.proxies_cfg.get("pool", [])
+        if idx is not None and 0 <= idx < len(pool):
+            return idx
+        return None
 
-            except Exception as e:
-                print(f"[СЕССИЯ] Не удалось подхватить {f.name}: {e}")
+    def _make_client(self, f: Path) -> TelegramClient:
+        idx = self._session_proxy_idx(f)
+        proxy_tuple = None
+        if idx is not None:
+            proxy_tuple = _telethon_proxy_tuple_from_cfg(self.proxies_cfg["pool"][idx])
+        return TelegramClient(str(f), API_ID, API_HASH, proxy=proxy_tuple)
+
+    def _register_snapshot_account(self, f: Path, snap: dict, client: TelegramClient,
+                                   seen_user_ids: set) -> Optional[Account]:
+        """Аккаунт из снимка личности — без get_me; подтверждение идёт в фоне (_revalidate_account)."""
+        uid = int(snap["user_id"])
+        if uid in seen_user_ids or uid in self.accounts:
+            return None
+        user = types.User(
+            id=uid,
+            first_name=snap.get("first_name"),
+            last_name=snap.get("last_name"),
+            username=snap.get("username"),
+        )
+        acc = Account(
+            session_path=f,
+            client=client,
+            user=user,
+            user_id=uid,
+            display=snap.get("display") or friendly_display(user),
+            last_used_ts=float(snap.get("last_used_ts") or 0.0),
+            session_key=str(snap.get("session_key") or ""),
+            validated=False
+        )
+        if client.is_connected():
+            acc.connected_ts = time.time()
+        seen_user_ids.add(uid)
+        self.accounts[uid] = acc
+        self._install_account_handlers(acc)
+        self.scheduler.add(uid, acc.last_used_ts)
+        self._add_account_to_ui(acc)
+        return acc
+
+    def _restore_hibernated_accounts(self, files: List[Path], snapshots: Dict[str, dict],
+                                     seen_user_ids: set) -> List[Path]:
+        """Поднимает аккаунты из снимков без подключения.
+        Возвращает сессии без годного снимка — их грузим обычным путём."""
+        rest = []
+        for f in files:
+            snap = snapshots.get(f.name)
+            acc = self._register_snapshot_account(f, snap, self._make_client(f), seen_user_ids) if snap else None
+            if acc:
+                self._mark_account_item(acc.user_id, "#9fb3d9", "Спит — подключится при использовании")
+            else:
+                rest.append(f)
+        return rest
+
+    async def _revalidate_account(self, acc: Account):
+        """Фоновая сверка снимка: get_me + проверка здоровья; при расхождении — выселяем."""
+        if acc.validated:
+            return
+        acc.validated = True  # заодно защита от параллельной сверки; при сбое сбрасываем
+        try:
+            # мимо _run_acc: его обработчик мёртвых сессий показывает модальное окно на каждый аккаунт
+            me = await asyncio.wait_for(acc.client.get_me(), self._rpc_budget(PRIO_BACKGROUND, None))
+        except (UserDeactivatedBanError, UserDeactivatedError,
+                SessionRevokedError, AuthKeyUnregisteredError) as e:
+            await self._drop_dead_session(acc, e.__class__.__name__)
+            return
+        except Exception as e:
+            print(f"[СЕССИЯ] Не удалось сверить {acc.session_path.name}: {e}")
+            acc.validated = False
+            QTimer.singleShot(60_000, lambda a=acc: self.accounts.get(a.user_id) is a
+                              and asyncio.create_task(self._revalidate_account(a)))
+            return
+        if not me or me.id != acc.user_id:
+            # сессия разлогинена или подменена — убираем снимок, сессию грузим заново
+            self._forget_account(acc)
+            try: await acc.client.disconnect()
+            except Exception: pass
+            if me:
+                try:
+                    await self._boot_session(acc.session_path, set(self.accounts.keys()))
+                except Exception as e:
+                    print(f"[СЕССИЯ] Не удалось подхватить {acc.session_path.name}: {e}")
+            self._rebuild_manual_acc_combo()
+            self._save_accounts_cache()
+            self._update_labels()
+            return
+        ok, reason = await self._probe_account_health(acc.client)
+        if not ok:
+            await self._drop_dead_session(acc, reason)
+            return
+        acc.user = me
+        acc.display = friendly_display(me)
+        self._add_account_to_ui(acc)
         self._rebuild_manual_acc_combo()
         self._save_accounts_cache()
         self._update_labels()
 
+    async def _drop_dead_session(self, acc: Account, reason: str):
+        """Как при загрузке без снимка: мёртвую сессию удаляем молча, с записью в лог."""
+        self._forget_account(acc)
+        try: await acc.client.disconnect()
+        except Exception: pass
+        try: acc.session_path.unlink(missing_ok=True)
+        except Exception: pass
+        print(f"[СЕССИЯ] Удалена сессия {acc.session_path.name}: {reason}")
+        self._save_accounts_cache()
+        self._update_labels()
+
+    async def _boot_session(self, f: Path, seen_user_ids: set, snapshot: Optional[dict] = None):
+        idx = self._session_proxy_idx(f)
+        client = self._make_client(f)
+        try:
+            await client.connect()
+            if snapshot:
+                acc = self._register_snapshot_account(f, snapshot, client, seen_user_ids)
+                if acc:
+                    if idx is not None:
+                        self.proxies_cfg.setdefault("assignments_by_user", {})[str(acc.user_id)] = idx
+                        _save_proxies_config(self.proxies_cfg)
+                    self._mark_account_item(acc.user_id, "#a0e6a0", "Проверка сессии…")
+                    asyncio.create_task(self._revalidate_account(acc))
+                    self._update_labels()
+                    return
+            me = await client.get_me()
+            if not me:
+                await client.disconnect(); return
+
+            ok, reason = await self._probe_account_health(client)
+        except asyncio.CancelledError:
+            # таймаут: не ждём зависший прокси, отключаемся в фоне
+            asyncio.ensure_future(client.disconnect())
+            raise
+        except Exception:
+            try: await client.disconnect()
+            except: pass
+            raise
+        if not ok:
+            try: await client.disconnect()
+            except: pass
+            try: f.unlink(missing_ok=True)
+            except: pass
+            print(f"[СЕССИЯ] Удалена сессия {f.name}: {reason}")
+            return
+
+        uid = me.id
+        if idx is not None:
+            self.proxies_cfg.setdefault("assignments_by_user", {})[str(uid)] = idx
+            _save_proxies_config(self.proxies_cfg)
+
+        if uid in seen_user_ids:
+            await client.disconnect()
+            try: f.unlink(missing_ok=True)
+            except: pass
+            return
+        seen_user_ids.add(uid)
+        acc = Account(
+            session_path=f,
+            client=client,
+            user=me,
+            user_id=uid,
+            display=friendly_display(me),
+            last_used_ts=self._cached_last_used.get(uid, 0.0),
+            connected_ts=time.time()
+        )
+        self.accounts[uid] = acc
+        self._install_account_handlers(acc)
+        self.scheduler.add(uid, acc.last_used_ts)
+        self._add_account_to_ui(acc)
+
+        tip = []
+        if idx is not None:
+            pr = self.proxies_cfg["pool"][idx]
+            tip.append(f"Прокси: {pr.get('scheme')}://{pr.get('host')}:{pr.get('port')}")
+        self._mark_account_item(uid, "#a0e6a0", " | ".join(tip))
+        self._update_labels()
+
     def _add_account_to_ui(self, acc: Account):
         if acc.user_id in self._uid_to_item:
             it = self._uid_to_item[acc.user_id]
@@ -1223,7 +3349,7 @@ class MainWindow(QMainWindow):
         fn, _ = QFileDialog.getOpenFileName(self, "Выберите картинку", "", "Изображения (*.png *.jpg *.jpeg *.webp)")
         if not fn: return
         try:
-            up = await self._run_acc(acc, acc.client.upload_file(fn))
+            up = await self._run_acc(acc, acc.client.upload_file(fn), timeout=SETTINGS["rpc_timeout_sec"]["transfer"])
             await self._run_acc(acc, acc.client(functions.photos.UploadProfilePhotoRequest(file=up)))
             await self._mb_info("Аватар", "Аватар обновлён.")
         except Exception as e:
@@ -1568,11 +3694,12 @@ class MainWindow(QMainWindow):
                 acc = Account(
                     session_path=client_holder["sess"],
                     client=cl, user=me, user_id=me.id,
-                    display=friendly_display(me), api_lock=asyncio.Lock()
+                    display=friendly_display(me),
+                    connected_ts=time.time()
                 )
                 self.accounts[me.id] = acc
-                if me.id not in self.rr_order:
-                    self.rr_order.append(me.id)
+                self._install_account_handlers(acc)
+                self.scheduler.add(me.id)
                 self._add_account_to_ui(acc)
                 self._rebuild_manual_acc_combo()
                 await self._mb_info("Успех", f"Добавлен {acc.display}")
@@ -1647,10 +3774,11 @@ class MainWindow(QMainWindow):
                 except: pass
                 return
             acc = Account(session_path=sess, client=client, user=me, user_id=me.id,
-                          display=friendly_display(me), api_lock=asyncio.Lock())
+                          display=friendly_display(me),
+                          connected_ts=time.time())
             self.accounts[me.id] = acc
-            if me.id not in self.rr_order:
-                self.rr_order.append(me.id)
+            self._install_account_handlers(acc)
+            self.scheduler.add(me.id)
             self._add_account_to_ui(acc)
             self._rebuild_manual_acc_combo()
             await self._mb_info("Успех", f"Добавлен {acc.display}")
@@ -1681,12 +3809,18 @@ class MainWindow(QMainWindow):
         if not cur: return
         uid = cur.data(Qt.UserRole)
         self.current_view_account_id = uid
+        view_acc = self.accounts.get(uid)
+        if view_acc:
+            try:
+                await self._ensure_connected(view_acc)
+            except Exception as e:
+                return await self._mb_warn("Аккаунт", f"Не удалось подключиться: {e}")
         await self._load_dialogs(uid)
         # если уже открыт чат — откроем его этим аккаунтом (без лишних закреплений)
         if self.current_entity_ref:
             acc = self.accounts.get(uid)
             if acc:
-                ent = await resolve_ref(acc.client, self.current_entity_ref)
+                ent = await self._resolve_ref(acc, self.current_entity_ref)
                 if ent:
                     await self._open_chat_with_entity(ent)
         self._rebuild_pins_bar()
@@ -1697,19 +3831,57 @@ class MainWindow(QMainWindow):
         acc = self.accounts.get(uid)
         if not acc: return
         self.dlg_list.clear()
-        try:
-            async with acc.api_lock:
+        async def _fill():
+            async with acc.rpc:
                 async for dlg in acc.client.iter_dialogs():
+                    if isinstance(dlg.entity, types.Channel) and not dlg.entity.left:
+                        acc.joined[dlg.entity.id] = True
                     title = human_dialog_title(dlg)
                     it = QListWidgetItem(title)
                     it.setData(Qt.UserRole, (utils.get_peer_id(dlg.entity), dlg.entity))
                     self.dlg_list.addItem(it)
+        fill = _fill()
+        try:
+            await asyncio.wait_for(fill, self._rpc_budget(PRIO_NORMAL, None))
+        except asyncio.TimeoutError:
+            self._mark_degraded(acc, "iter_dialogs", self._rpc_budget(PRIO_NORMAL, None) or 0)
+            # список обрезан — показываем это и даём перечитать
+            it = QListWidgetItem("⚠ Список неполный (таймаут) — нажмите, чтобы повторить")
+            it.setForeground(QColor("#e3b341"))
+            it.setData(Qt.UserRole, ("retry", uid))
+            self.dlg_list.addItem(it)
         except Exception as e:
             await self._mb_crit("Диалоги", f"{e}")
+        finally:
+            fill.close()  # если wait_for так и не запустил корутину — без «never awaited»
+
+    # ----- Поколения чата: отмена устаревших загрузок -----
+    def _begin_chat_generation(self) -> int:
+        """
+        Новый показ чата: отменяем загрузки/авторов/медиа прежнего. Вызывающую задачу не трогаем —
+        она сверяет возвращённый номер с _chat_gen после своих await.
+        """
+        self._chat_gen += 1
+        for t in list(self._chat_tasks):
+            t.cancel()
+        self._chat_tasks.clear()
+        return self._chat_gen
+
+    def _track_chat_task(self, task: asyncio.Task) -> asyncio.Task:
+        self._chat_tasks.add(task)
+        task.add_done_callback(self._chat_tasks.discard)
+        return task
+
+    def _chat_task(self, coro) -> asyncio.Task:
+        """Задача, живущая не дольше текущего показа чата."""
+        return self._track_chat_task(asyncio.create_task(coro))
 
     def _on_dialog_clicked(self, item: QListWidgetItem):
         info = item.data(Qt.UserRole)
         if not info: return
+        if info[0] == "retry":
+            asyncio.create_task(self._load_dialogs(info[1]))
+            return
         _, entity = info
         asyncio.create_task(self._open_chat_with_entity(entity))
 
@@ -1721,25 +3893,32 @@ class MainWindow(QMainWindow):
         acc = self.accounts[uid]
         try:
             if ref.startswith("@"): ref = ref[1:]
-            entity = await self._run_acc(acc, acc.client.get_entity(ref))
+            if re.fullmatch(r"[A-Za-z][A-Za-z0-9_]{3,31}", ref):
+                entity = await self._resolve_ref(acc, f"username:{ref}")  # через кеш и общий справочник ников
+            else:
+                entity = await self._run_acc(acc, acc.client.get_entity(ref), action="resolve")
+            if entity is None:
+                raise ValueError(f"Не найдено: {ref}")
             await self._open_chat_with_entity(entity)
         except Exception as e:
             await self._mb_crit("Открытие", f"{e}")
 
     async def _open_chat_with_entity(self, entity):
-        if self._comments_timer.isActive():
-            self._comments_timer.stop()
         self._comments_ctx_entity_ref = None
         self._comments_ctx_post_id = None
         self._comments_ctx_root_discussion_id = None
         self._comments_ctx_acc = None
+        self._comments_ctx_discussion_id = None
         self._comments_known_ids.clear()
         self._clear_reply_keyboard()
-        
+        gen = self._begin_chat_generation()
+
         uid = self.current_view_account_id
         if uid is None: return
         acc = self.accounts[uid]
-        await self._run_acc(acc, ensure_join(acc.client, entity))
+        await self._ensure_join(acc, entity)
+        if gen != self._chat_gen:
+            return  # пока вступали, открыли другой чат
         try:
             if isinstance(entity, types.User): title = utils.get_display_name(entity)
             elif isinstance(entity, (types.Chat, types.Channel)): title = entity.title
@@ -1755,61 +3934,102 @@ class MainWindow(QMainWindow):
 
 
     def _clear_chat_area(self):
-        for i in reversed(range(self.chat_v.count() - 1)):
-            w = self.chat_v.itemAt(i).widget()
-            if w: w.setParent(None)
+        self.chat_model.reset([])
 
-    async def _maybe_resolve_and_set_author(self, client: TelegramClient, bubble: MessageBubble, msg: types.Message):
+    async def _maybe_resolve_and_set_author(self, acc: Account, bubble: MessageBubble, msg: types.Message):
         try:
+            sid = getattr(msg, "sender_id", None)
+            if not sid:
+                from_id = getattr(msg, "from_id", None)
+                sid = utils.get_peer_id(from_id) if from_id else None
             if msg.sender:
+                self.author_resolver.remember(sid, msg.sender)  # пригодится для сообщений без sender
                 return
+            if sid:
+                name = await self.author_resolver.name(acc, sid)
+                if name:
+                    bubble.set_author(name)
+        except Exception:
+            pass
+
+    async def _resolve_chat_row_author(self, acc: Account, msg: types.Message):
+        try:
             sid = getattr(msg, "sender_id", None)
             if not sid:
                 from_id = getattr(msg, "from_id", None)
                 sid = utils.get_peer_id(from_id) if from_id else None
-            if sid:
-                ent = await client.get_entity(sid)
-                bubble.set_author(friendly_display(ent))
+            if not sid:
+                return
+            name = await self.author_resolver.name(acc, sid)
+            if name:
+                self._update_chat_row(msg.id, lambda r: setattr(r, "author", name))
         except Exception:
             pass
 
-    async def _load_messages(self, acc: Account, entity, limit=60):
+    def _make_chat_row(self, h: ChatHistory, m: types.Message) -> ChatRow:
+        row = ChatRow.from_message(m, h.allowed)
+        if m.sender:
+            sid = getattr(m, "sender_id", None)
+            if sid:
+                self.author_resolver.remember(sid, m.sender)  # пригодится для сообщений без sender
+        else:
+            self._chat_task(self._resolve_chat_row_author(h.src, m))
+        return row
+
+    def _update_chat_row(self, msg_id: int, fn):
+        self.chat_view.refresh(self.chat_model.update(msg_id, fn))
+
+    def _on_chat_comments_clicked(self, msg: types.Message):
+        h = self._history
+        if h:
+            asyncio.create_task(self._open_comments_for_post(h.acc, h.entity, msg))
+
+    def _on_chat_media_clicked(self, msg: types.Message):
+        h = self._history
+        if h:
+            self._chat_task(self._load_media_into_row(h.src, msg))
+
+    async def _load_messages(self, acc: Account, entity, limit: Optional[int] = None):
+        """Сама загрузка — задача показа (её отменит следующий чат); вызывающий только дожидается её."""
+        self._begin_chat_generation()
+        await asyncio.wait({self._chat_task(self._fill_chat(acc, entity, limit))})
+
+    async def _fill_chat(self, acc: Account, entity, limit: Optional[int] = None):
         self._clear_chat_area()
+        self._history = None
         self._last_loaded_messages = []
-        media_to_autoload: List[types.Message] = []
+        limit = limit or int(SETTINGS["history_page_size"])
         try:
-            msgs = await self._run_acc(acc, acc.client.get_messages(entity, limit=limit))
-            allowed = await self._run_acc(acc, get_allowed_reaction_emojis(acc.client, entity))
-            self._last_loaded_messages = list(msgs)
-            for m in msgs:
-                outgoing = bool(m.out); can_react = True
-                try:
-                    r = getattr(m, "reactions", None)
-                    if r and hasattr(r, "can_set") and r.can_set is False:
-                        can_react = False
-                except Exception:
-                    pass
-                bubble = MessageBubble(m, outgoing, can_react, show_reply_btn=True, emojis=allowed, parent=self.chat_inner)
-                # реакция — вызываем общий обработчик (сам получит нужный peer)
-                bubble.reactClicked.connect(lambda message, emoji: asyncio.create_task(self._on_react_in_chat(message, emoji)))
-                bubble.commentsClicked.connect(lambda msg, a=acc, e=entity: asyncio.create_task(self._open_comments_for_post(a, e, msg)))
-                
-                bubble.inlineButtonClicked.connect(lambda message, info: asyncio.create_task(self._on_inline_button(message, info)))
-                if bubble.media_btn:
-                    bubble.media_btn.clicked.connect(lambda _, msg=m, widget=bubble: asyncio.create_task(self._load_media_into_bubble(acc, msg, widget)))
-                    media_to_autoload.append(m)
-                self.chat_v.insertWidget(self.chat_v.count() - 1, bubble)
-                asyncio.create_task(self._maybe_resolve_and_set_author(acc.client, bubble, m))
+            ref = entity_ref(entity)
+            peer_id = utils.get_peer_id(entity)
+            stored = self.message_store.load(acc.user_id, peer_id, limit)
+            if stored:
+                # сразу показываем локальную копию, потом добираем новое и правки
+                allowed = reaction_policy.get(entity.id) if isinstance(entity, types.Channel) else None
+                h = self._show_history(acc, acc, entity, ref, allowed or DEFAULT_REACTION_EMOJIS, stored, limit)
+                h = await self._sync_stored_history(h, peer_id, stored, limit)
+                if allowed is None and h is self._history:
+                    h.allowed = await self._allowed_reactions(acc, entity)
+                    for r in self.chat_model.rows():
+                        r.allowed = h.allowed
+            else:
+                msgs, src = await self._hedged_read(
+                    acc, entity, ref,
+                    lambda a, peer: a.client.get_messages(peer, limit=limit), kind="get_messages"
+                )
+                allowed = await self._allowed_reactions(acc, entity)
+                h = self._show_history(acc, src, entity, ref, allowed, list(msgs), limit)
+                self.message_store.put(src.user_id, peer_id, h.pages[0])
+            if h is not self._history:
+                return
 
             if self.cb_autoshow_media.isChecked():
-                for m in media_to_autoload[:5]:
-                    for i in range(self.chat_v.count()):
-                        w = self.chat_v.itemAt(i).widget()
-                        if isinstance(w, MessageBubble) and w.msg.id == m.id and w.media_btn:
-                            await self._load_media_into_bubble(acc, m, w); break            # обновим панель reply-клавиатуры
+                for r in [r for r in self.chat_model.rows() if r.has_media][:5]:
+                    await self._load_media_into_row(h.src, r.msg)
+            # обновим панель reply-клавиатуры
             try:
                 kb = None
-                for _m in msgs:
+                for _m in h.messages():
                     _rm = getattr(_m, 'reply_markup', None)
                     if isinstance(_rm, types.ReplyKeyboardMarkup):
                         kb = _rm
@@ -1821,12 +4041,129 @@ class MainWindow(QMainWindow):
 
         except Exception as e:
             await self._mb_crit('Сообщения', f'{e}')
-    def _find_chat_bubble(self, msg_id: int) -> Optional[MessageBubble]:
-        for i in range(self.chat_v.count()):
-            w = self.chat_v.itemAt(i).widget()
-            if isinstance(w, MessageBubble) and w.msg and w.msg.id == msg_id:
-                return w
-        return None
+
+    def _show_history(self, acc: Account, src: Account, entity, ref: str, allowed: List[str],
+                      page: List[types.Message], limit: int) -> ChatHistory:
+        h = ChatHistory(acc=acc, src=src, entity=entity, ref=ref, allowed=allowed)
+        h.pages.append(page)
+        h.has_older = len(page) >= limit
+        self._history = h
+        self._last_loaded_messages = h.messages()
+        self.chat_model.reset([self._make_chat_row(h, m) for m in page])
+        return h
+
+    async def _sync_stored_history(self, h: ChatHistory, peer_id: int, stored: List[types.Message],
+                                   limit: int) -> ChatHistory:
+        """
+        Дельта к странице из хранилища: сообщения новее max id и правки/удаления среди показанных.
+        Возвращает актуальное окно (при большом пропуске оно строится заново).
+        """
+        acc = h.src
+        try:
+            fresh = list(await self._run_acc(acc, acc.client.get_messages(h.entity, limit=limit, min_id=h.newest_id),
+                                             kind="get_messages", ref=h.ref))
+            if h is not self._history:
+                return h
+            if len(fresh) >= limit:
+                # пропуск длиннее страницы — локальная копия устарела, показываем свежую страницу
+                self.message_store.put(acc.user_id, peer_id, fresh)
+                return self._show_history(h.acc, acc, h.entity, h.ref, h.allowed, fresh, limit)
+            current = await self._run_acc(acc, acc.client.get_messages(h.entity, ids=[m.id for m in stored]),
+                                          kind="get_messages", ref=h.ref)
+            if h is not self._history:
+                return h
+            gone = [m.id for m, cur in zip(stored, current) if cur is None]
+            # с медиа берём свежую копию всегда: у сохранённой file_reference мог истечь
+            changed = [cur for m, cur in zip(stored, current)
+                       if cur is not None and (cur.media or _message_signature(cur) != _message_signature(m))]
+            if gone:
+                self._drop_messages(h, set(gone))
+                self.message_store.delete(acc.user_id, peer_id, gone)
+            if fresh or changed:
+                self._merge_live_messages(h, fresh + changed)
+                self.message_store.put(acc.user_id, peer_id, fresh + changed)
+        except Exception as e:
+            print(f"[HISTORY] {e}")  # остаёмся на локальной копии
+        return h
+
+    def _drop_messages(self, h: ChatHistory, ids: Set[int]):
+        for page in h.pages:
+            page[:] = [m for m in page if m.id not in ids]
+        self.chat_model.remove_ids(ids)
+        self._last_loaded_messages = h.messages()
+
+    # ----- Постраничная история -----
+    def _on_chat_scrolled(self, value: int):
+        h = self._history
+        if not h or h.loading:
+            return
+        sb = self.chat_view.verticalScrollBar()
+        margin = int(sb.pageStep() * float(SETTINGS.get("history_prefetch_screens") or 1))
+        if h.has_older and value >= sb.maximum() - margin:
+            self._chat_task(self._load_history_page(older=True))
+        elif h.has_newer and value <= margin:
+            self._chat_task(self._load_history_page(older=False))
+
+    async def _load_history_page(self, *, older: bool):
+        """Догружает страницу старее (вниз) или новее (вверх) по offset_id; лишние страницы с другого края выгружаются."""
+        h = self._history
+        if not h or h.loading:
+            return
+        h.loading = True
+        try:
+            limit = int(SETTINGS["history_page_size"])
+            peer = await self._resolve_ref(h.src, h.ref)
+            if not peer:
+                return
+            if older:
+                msgs = await self._run_acc(h.src, h.src.client.get_messages(peer, limit=limit, offset_id=h.oldest_id),
+                                           kind="get_messages", ref=h.ref)
+                page = list(msgs)
+            else:
+                msgs = await self._run_acc(h.src, h.src.client.get_messages(peer, limit=limit, offset_id=h.newest_id,
+                                                                              reverse=True),
+                                           kind="get_messages", ref=h.ref)
+                page = list(reversed(list(msgs)))  # reverse=True отдаёт по возрастанию
+            if h is not self._history:
+                return
+            self.message_store.put(h.src.user_id, utils.get_peer_id(h.entity), page)
+            if older:
+                h.has_older = len(page) >= limit
+            else:
+                h.has_newer = len(page) >= limit
+            if not page:
+                return
+
+            shift = 0  # на сколько сдвинулось содержимое над текущей позицией прокрутки
+            rows = [self._make_chat_row(h, m) for m in page]
+            if older:
+                h.pages.append(page)
+                self.chat_model.insert_rows(self.chat_model.rowCount(), rows)
+            else:
+                h.pages.appendleft(page)
+                self.chat_model.insert_rows(0, rows)
+                shift += sum(self.chat_view.row_height(r) for r in rows)
+
+            max_pages = max(2, int(SETTINGS.get("history_max_pages") or 2))
+            while len(h.pages) > max_pages:
+                evicted = h.pages.popleft() if older else h.pages.pop()
+                if older:
+                    h.has_newer = True
+                else:
+                    h.has_older = True
+                removed = self.chat_model.remove_ids({m.id for m in evicted})
+                if older:
+                    shift -= sum(self.chat_view.row_height(r) for r in removed)
+            self._last_loaded_messages = h.messages()
+            if shift:
+                sb = self.chat_view.verticalScrollBar()
+                value = sb.value()
+                self.chat_view.settle()
+                sb.setValue(value + shift)
+        except Exception as e:
+            print(f"[HISTORY] {e}")
+        finally:
+            h.loading = False
 
     def _select_main_reply_target(self, message: types.Message):
         self._main_reply_target = message
@@ -1846,19 +4183,41 @@ class MainWindow(QMainWindow):
         self.reply_info_main.setText("")
         self.reply_cancel_main.setVisible(False)
 
-    async def _load_media_into_bubble(self, acc: Account, msg: types.Message, bubble: MessageBubble):
+    async def _load_media_into_row(self, acc: Account, msg: types.Message):
+        row = self.chat_model.find(msg.id)
+        if row is None or row.media_state:
+            return
+        self._update_chat_row(msg.id, lambda r: setattr(r, "media_state", "loading"))
         try:
             from io import BytesIO
             bio = BytesIO()
-            await self._run_acc(acc, acc.client.download_media(msg, file=bio))
+            try:
+                await self._run_acc(acc, acc.client.download_media(msg, file=bio),
+                                    timeout=SETTINGS["rpc_timeout_sec"]["transfer"])
+            except RPCError as e:
+                if "FILE_REFERENCE" not in (getattr(e, "message", "") or "").upper() or not self._history:
+                    raise
+                # копия из хранилища со старой file_reference — перечитываем сообщение и пробуем ещё раз
+                h = self._history
+                fresh = await self._run_acc(acc, acc.client.get_messages(h.entity, ids=msg.id),
+                                            kind="get_messages", ref=h.ref)
+                if not fresh:
+                    raise
+                msg = fresh
+                self._replace_live_message(h, msg)
+                self._update_chat_row(msg.id, lambda r: setattr(r, "media_state", "loading"))
+                self.message_store.put(acc.user_id, utils.get_peer_id(h.entity), [msg])
+                bio = BytesIO()
+                await self._run_acc(acc, acc.client.download_media(msg, file=bio),
+                                    timeout=SETTINGS["rpc_timeout_sec"]["transfer"])
             if bio.getbuffer().nbytes == 0:
+                self._update_chat_row(msg.id, lambda r: setattr(r, "media_state", "done"))
                 return await self._mb_info("Медиа", "Нечего показать.")
             data = bio.getvalue()
             pm = QPixmap()
             if pm.loadFromData(data):
-                lbl = QLabel(self.chat_inner); lbl.setPixmap(pm.scaledToWidth(460, Qt.SmoothTransformation))
-                bubble.layout().insertWidget(2, lbl)
-                bubble.media_btn.setVisible(False)
+                pm = pm.scaledToWidth(min(460, pm.width()), Qt.SmoothTransformation)
+                self._update_chat_row(msg.id, lambda r: (setattr(r, "media_pm", pm), setattr(r, "media_state", "done")))
             else:
                 if self.cb_save_unknown.isChecked():
                     tmp = ROOT / "downloads"; tmp.mkdir(exist_ok=True)
@@ -1867,8 +4226,9 @@ class MainWindow(QMainWindow):
                     await self._mb_info("Медиа", f"Файл сохранён: {fname}")
                 else:
                     await self._mb_info("Медиа", "Тип медиа не поддерживается для предпросмотра.")
-                bubble.media_btn.setVisible(False)
+                self._update_chat_row(msg.id, lambda r: setattr(r, "media_state", "done"))
         except Exception as e:
+            self._update_chat_row(msg.id, lambda r: setattr(r, "media_state", ""))
             await self._mb_crit("Медиа", f"{e}")
 
     # ----- Пины (глобальные) -----
@@ -1893,9 +4253,9 @@ class MainWindow(QMainWindow):
         if uid is None or uid not in self.accounts: return
         acc = self.accounts[uid]
         try:
-            ent = await self._run_acc(acc, resolve_ref(acc.client, ref))
+            ent = await self._resolve_ref(acc, ref)
             if not ent: return
-            await self._run_acc(acc, ensure_join(acc.client, ent))
+            await self._ensure_join(acc, ent)
             await self._open_chat_with_entity(ent)
         except Exception as e:
             await self._mb_warn("Закреплённые", f"{e}")
@@ -1917,7 +4277,7 @@ class MainWindow(QMainWindow):
                 title = r
                 if acc:
                     try:
-                        ent = await resolve_ref(acc.client, r)
+                        ent = await self._resolve_ref(acc, r, priority=PRIO_BACKGROUND)
                         if ent:
                             if isinstance(ent, types.User): title = utils.get_display_name(ent)
                             elif isinstance(ent, (types.Chat, types.Channel)): title = ent.title
@@ -1942,9 +4302,11 @@ class MainWindow(QMainWindow):
             return self.accounts.get(uid)
         elif mode == "Рандомно":
             return None
+        elif mode == "Давно не использованный":
+            lru = self.scheduler.least_recent(1)
+            return self.accounts.get(lru[0]) if lru else None
         else:
-            if not self.rr_order: return None
-            uid = self.rr_order[self._rr_pointer % len(self.rr_order)]
+            uid = self.scheduler.next_eligible(advance=False)
             return self.accounts.get(uid)
 
     def _peek_next_after(self, current: Optional[Account]) -> Optional[Account]:
@@ -1957,13 +4319,14 @@ class MainWindow(QMainWindow):
         elif mode == "Рандомно":
             return None
         else:
-            if not self.rr_order: return None
-            if current and current.user_id in self.rr_order:
-                i = self.rr_order.index(current.user_id)
-                uid = self.rr_order[(i+1) % len(self.rr_order)]
-                return self.accounts.get(uid)
-            uid = self.rr_order[self._rr_pointer % len(self.rr_order)]
-            return self.accounts.get(uid)
+            if mode == "Давно не использованный":
+                head = self.scheduler.least_recent(2)
+            else:
+                head = self.scheduler.peek(2)
+            if not head: return None
+            if current and head[0] == current.user_id:
+                return self.accounts.get(head[-1])
+            return self.accounts.get(head[0])
 
     def _update_labels(self):
         cur = self._peek_send_account()
@@ -1973,6 +4336,12 @@ class MainWindow(QMainWindow):
 
     # ----- Выбор аккаунта -----
     async def _choose_account_for_send(self, *, advance: bool = True) -> Optional[Account]:
+        acc = self._pick_account_for_send(advance=advance)
+        if acc:
+            await self._ensure_connected(acc)
+        return acc
+
+    def _pick_account_for_send(self, *, advance: bool = True) -> Optional[Account]:
         if not self.accounts: return None
         if not self.cb_auto.isChecked():
             uid = self.current_view_account_id
@@ -1982,17 +4351,20 @@ class MainWindow(QMainWindow):
             uid = self.manual_acc.currentData(Qt.UserRole)
             return self.accounts.get(uid)
         elif mode == "Рандомно":
-            uid = random.choice(list(self.accounts.keys()))
-            return self.accounts[uid]
+            return self._random_ready_account()
+        elif mode == "Давно не использованный":
+            return self._least_recent_account(advance=advance)
         else:
-            if not self.rr_order: return None
-            uid = self.rr_order[self._rr_pointer % len(self.rr_order)]
-            acc = self.accounts[uid]
-            if advance:
-                self._rr_pointer = (self._rr_pointer + 1) % len(self.rr_order)
-            return acc
-
-    def _choose_account_for_reaction(self) -> Optional[Account]:
+            uid = self.scheduler.next_eligible(advance=advance)
+            return self.accounts.get(uid)
+
+    async def _choose_account_for_reaction(self) -> Optional[Account]:
+        acc = self._pick_account_for_reaction()
+        if acc:
+            await self._ensure_connected(acc)
+        return acc
+
+    def _pick_account_for_reaction(self) -> Optional[Account]:
         """Для реакций: поочерёдно/рандом/ручной; если авто-режим выключен — тоже используем rr-очередь."""
         if not self.accounts: return None
         if self.cb_auto.isChecked():
@@ -2001,28 +4373,234 @@ class MainWindow(QMainWindow):
                 uid = self.manual_acc.currentData(Qt.UserRole)
                 return self.accounts.get(uid)
             elif mode == "Рандомно":
-                uid = random.choice(list(self.accounts.keys()))
-                return self.accounts[uid]
+                return self._random_ready_account()
+            elif mode == "Давно не использованный":
+                return self._least_recent_account(advance=False)
             else:
-                uid = self.rr_order[self._rr_pointer % len(self.rr_order)]
+                uid = self.scheduler.next_eligible(advance=False)
                 return self.accounts.get(uid)
         else:
-            if self.rr_order:
-                uid = self.rr_order[self._rr_pointer % len(self.rr_order)]
+            if len(self.scheduler):
+                uid = self.scheduler.next_eligible(advance=False)
                 return self.accounts.get(uid)
             return self.accounts.get(self.current_view_account_id)
 
+    def _least_recent_account(self, *, advance: bool) -> Optional[Account]:
+        lru = self.scheduler.least_recent(1)
+        acc = self.accounts.get(lru[0]) if lru else None
+        if acc and advance:
+            # сразу двигаем в конец, чтобы параллельная отправка не взяла тот же аккаунт
+            self._touch_account(acc)
+        return acc
+
+    def _random_ready_account(self) -> Optional[Account]:
+        ready = [uid for uid in self.scheduler.ready_ids() if uid in self.accounts]
+        return self.accounts[random.choice(ready)] if ready else None
+
+    def _no_account_text(self) -> str:
+        wait = self.scheduler.time_until_free()
+        if wait:
+            return f"Все аккаунты на лимите. Ближайший освободится через {int(wait) + 1} с."
+        return "Нет доступного аккаунта."
+
     # ----- InputPeer cache -----
+    # ----- Членство в каналах -----
+    async def _ensure_join(self, acc: Account, entity):
+        """Вступает в канал, если нужно; по индексу членства аккаунта для уже вступивших — ноль запросов."""
+        if not isinstance(entity, types.Channel):
+            return
+        state = acc.joined.get(entity.id)
+        if state is None and getattr(entity, "left", None) is False:
+            state = acc.joined[entity.id] = True
+        if state:
+            return
+        try:
+            await self._run_acc(acc, acc.client(JoinChannelRequest(entity)), action="join")
+            acc.joined[entity.id] = True
+        except UserAlreadyParticipantError:
+            acc.joined[entity.id] = True
+        except Exception:
+            pass
+
+    def _install_account_handlers(self, acc: Account):
+        async def _on_channel_update(update, a=acc):
+            # членство могло поменяться (кик/выход/бан) — или это смена названия/фото; состояние
+            # становится неизвестным, _ensure_join выведет его из entity.left без JoinChannel
+            cid = getattr(update, "channel_id", None)
+            if cid is not None:
+                a.joined.pop(cid, None)
+                self.entity_cache.forget_channel(a.user_id, cid)  # иначе _ensure_join возьмёт старый left
+                self.discussion_cache.invalidate(a.user_id, cid)  # могли сменить привязанный чат
+                reaction_policy.invalidate(cid)                   # …или набор разрешённых реакций
+        acc.client.add_event_handler(_on_channel_update, events.Raw(types=types.UpdateChannel))
+
+        # живые обновления: события приходят всем клиентам, применяем только к окну, чьими id оно наполнено
+        async def _on_new(event, a=acc):
+            self._on_live_message(a, event.message, edited=False)
+
+        async def _on_edited(event, a=acc):
+            self._on_live_message(a, event.message, edited=True)
+
+        async def _on_deleted(event, a=acc):
+            self._on_live_deleted(a, event.chat_id, set(event.deleted_ids or []))
+
+        async def _on_reactions(update, a=acc):
+            self._on_live_reactions(a, utils.get_peer_id(update.peer), update.msg_id, update.reactions)
+
+        acc.client.add_event_handler(_on_new, events.NewMessage())
+        acc.client.add_event_handler(_on_edited, events.MessageEdited())
+        acc.client.add_event_handler(_on_deleted, events.MessageDeleted())
+        acc.client.add_event_handler(_on_reactions, events.Raw(types=types.UpdateMessageReactions))
+
+    # ----- Живые обновления -----
+    def _live_history(self, acc: Account, chat_id: Optional[int]) -> Optional[ChatHistory]:
+        h = self._history
+        if h is None or chat_id is None:
+            return None
+        # id сообщений канала общие для всех аккаунтов — если страницу отдал дубль, слушаем и аккаунт просмотра
+        if h.src is not acc and not (h.acc is acc and isinstance(h.entity, types.Channel)):
+            return None
+        return h if utils.get_peer_id(h.entity) == chat_id else None
+
+    def _live_comments(self, acc: Account, chat_id: Optional[int]) -> bool:
+        return (self._comments_ctx_acc is acc and chat_id is not None
+                and chat_id == self._comments_ctx_discussion_id)
+
+    def _in_comment_thread(self, m: types.Message) -> bool:
+        root = self._comments_ctx_root_discussion_id
+        rt = getattr(m, "reply_to", None)
+        if not root or not rt:
+            return False
+        return (getattr(rt, "reply_to_top_id", None) or getattr(rt, "reply_to_msg_id", None)) == root
+
+    def _on_live_message(self, acc: Account, m: types.Message, *, edited: bool):
+        try:
+            chat_id = utils.get_peer_id(m.peer_id)
+            h = self._live_history(acc, chat_id)
+            if h is not None:
+                if edited:
+                    self._replace_live_message(h, m)
+                elif not h.has_newer:  # окно у живого края — новое сообщение дописываем сверху
+                    self._merge_live_messages(h, [m])
+                    self._apply_reply_kb_delta([m])
+                self.message_store.put(acc.user_id, chat_id, [m])
+            if self._live_comments(acc, chat_id):
+                if edited:
+                    bub = self.comments.replace_comment_bubble(m, bool(m.out), self._comments_ctx_allowed)
+                elif m.id not in self._comments_known_ids and self._in_comment_thread(m):
+                    bub = self.comments.add_comment_bubble_top(m, bool(m.out), emojis=self._comments_ctx_allowed)
+                    self._comments_known_ids.add(m.id)
+                else:
+                    bub = None
+                if bub:
+                    asyncio.create_task(self._maybe_resolve_and_set_author(acc, bub, m))
+        except Exception as e:
+            print(f"[LIVE] {e}")
+
+    def _replace_live_message(self, h: ChatHistory, m: types.Message):
+        for page in h.pages:
+            for i, x in enumerate(page):
+                if x.id == m.id:
+                    page[i] = m
+                    self.chat_view.refresh(self.chat_model.replace_row(self._make_chat_row(h, m)))
+                    self._last_loaded_messages = h.messages()
+                    return
+
+    def _on_live_deleted(self, acc: Account, chat_id: Optional[int], ids: Set[int]):
+        if not ids:
+            return
+        try:
+            h = self._history
+            if chat_id is None:
+                # вне каналов сервер не называет чат, но id там уникальны в пределах аккаунта
+                if h is not None and h.src is acc and not isinstance(h.entity, types.Channel):
+                    self._drop_messages(h, ids)
+                    self.message_store.delete(acc.user_id, utils.get_peer_id(h.entity), ids)
+                return
+            h = self._live_history(acc, chat_id)
+            if h is not None:
+                self._drop_messages(h, ids)
+            self.message_store.delete(acc.user_id, chat_id, ids)
+            if self._live_comments(acc, chat_id):
+                self.comments.remove_comment_bubbles(ids)
+                self._comments_known_ids -= ids
+        except Exception as e:
+            print(f"[LIVE] {e}")
+
+    def _on_live_reactions(self, acc: Account, chat_id: int, msg_id: int, reactions):
+        try:
+            if self._live_history(acc, chat_id) is not None:
+                row = self.chat_model.find(msg_id)
+                if row is not None:
+                    row.msg.reactions = reactions
+                    counts = _reaction_counts(row.msg)
+                    self._update_chat_row(msg_id, lambda r: setattr(r, "reactions", counts))
+                    self.message_store.put(acc.user_id, chat_id, [row.msg])
+            if self._live_comments(acc, chat_id):
+                bub = self.comments.comment_bubble(msg_id)
+                if bub:
+                    bub.msg.reactions = reactions
+                    bub.set_reactions(_reaction_counts(bub.msg))
+                    self.message_store.put(acc.user_id, chat_id, [bub.msg])
+        except Exception as e:
+            print(f"[LIVE] {e}")
+
+    async def _resolve_ref(self, acc: Account, ref: str, *, priority: Optional[int] = None):
+        """resolve_ref через кеш сущностей: память → диск (дешёвый get_entity) → полный резолв."""
+        ent = self.entity_cache.get(acc.user_id, ref)
+        if ent is not None:
+            return ent
+        ip = self.entity_cache.get_input(acc.user_id, ref)
+        if ip is not None:
+            try:
+                ent = await self._run_acc(acc, acc.client.get_entity(ip), priority=priority, kind="get_entity")
+            except (ValueError, *STALE_PEER_ERRORS):
+                self.entity_cache.invalidate(acc.user_id, ref)
+                ent = None
+        if ent is None and ref.startswith("username:"):
+            ent = await self._resolve_via_username_dir(acc, ref.split(":", 1)[1], priority)
+        if ent is None:
+            ent = await self._run_acc(acc, resolve_ref(acc.client, ref), action="resolve", priority=priority)
+            if ent is not None and ref.startswith("username:"):
+                self.username_dir.put(ent)
+        if ent is not None:
+            self.entity_cache.put(acc.user_id, ref, ent)
+        return ent
+
+    async def _resolve_via_username_dir(self, acc: Account, uname: str, priority: Optional[int]):
+        """Ник уже резолвил другой аккаунт: берём id из справочника и access_hash — из своей сессии."""
+        known = self.username_dir.get(uname)
+        if not known:
+            return None
+        kind, pid = known
+        alias = f"{kind}:{pid}"
+        ent = self.entity_cache.get(acc.user_id, alias)
+        if ent is None:
+            ip = self.entity_cache.get_input(acc.user_id, alias)
+            if ip is None:
+                peer = types.PeerUser(pid) if kind == "user" else types.PeerChannel(pid)
+                try:
+                    ip = acc.client.session.get_input_entity(peer)  # только локальная сессия, без сети
+                except Exception:
+                    return None  # этот аккаунт сущность не видел — нужен честный резолв
+            try:
+                ent = await self._run_acc(acc, acc.client.get_entity(ip), priority=priority, kind="get_entity")
+            except (ValueError, *STALE_PEER_ERRORS):
+                return None
+        if uname.lower() not in _entity_usernames(ent):
+            self.username_dir.invalidate(uname)  # ник сменил владельца
+            return None
+        return ent
+
     async def _get_input_peer(self, acc: Account, ref: str):
-        key = (acc.user_id, ref)
-        if key in self._peer_cache:
-            return self._peer_cache[key]
-        ent = await resolve_ref(acc.client, ref)
+        ip = self.entity_cache.get_input(acc.user_id, ref)
+        # кеш заполняют и пути без вступления — каналу без подтверждённого членства нужен _ensure_join
+        if ip is not None and (not isinstance(ip, types.InputPeerChannel) or acc.joined.get(ip.channel_id)):
+            return ip
+        ent = await self._resolve_ref(acc, ref)
         if not ent: return None
-        await ensure_join(acc.client, ent)
-        ip = await acc.client.get_input_entity(ent)
-        self._peer_cache[key] = ip
-        return ip
+        await self._ensure_join(acc, ent)
+        return utils.get_input_peer(ent)
 
     # ----- Отправка обычных сообщений -----
     _pending_file_path: Optional[str] = None
@@ -2047,7 +4625,7 @@ class MainWindow(QMainWindow):
             return await self._mb_info("Отправка", "Откройте чат.")
         chosen_acc = await self._choose_account_for_send(advance=True)
         if not chosen_acc:
-            return await self._mb_info("Отправка", "Нет доступного аккаунта.")
+            return await self._mb_info("Отправка", self._no_account_text())
         self._update_labels()
 
         ip = await self._get_input_peer(chosen_acc, self.current_entity_ref)
@@ -2057,18 +4635,14 @@ class MainWindow(QMainWindow):
             reply_to_id = self._main_reply_target.id if self._main_reply_target else None
             if self._pending_file_path:
                 path = self._pending_file_path
-                await self._run_acc(chosen_acc, chosen_acc.client.send_file(ip, path, caption=text or None, reply_to=reply_to_id))
+                sent = await self._send_file_cached(chosen_acc, ip, path, caption=text or None, reply_to=reply_to_id,
+                                                    ref=self.current_entity_ref)
                 self._set_pending_main_file(None)
             else:
-                await self._run_acc(chosen_acc, chosen_acc.client.send_message(ip, text, reply_to=reply_to_id))
+                sent = await self._run_acc(chosen_acc, chosen_acc.client.send_message(ip, text, reply_to=reply_to_id),
+                                           action="send", ref=self.current_entity_ref)
             self.input.clear(); self._clear_main_reply_target()
-            view_uid = self.current_view_account_id
-            if view_uid is not None:
-                view_acc = self.accounts.get(view_uid)
-                if view_acc:
-                    ent = await resolve_ref(view_acc.client, self.current_entity_ref)
-                    if ent:
-                        await self._load_messages(view_acc, ent)
+            await self._refresh_after_send(sent, chosen_acc)
             self._update_labels()
         except (PeerFloodError, FloodWaitError) as e:
             await self._mb_warn("Лимит", f"Временный лимит: {e}")
@@ -2078,6 +4652,202 @@ class MainWindow(QMainWindow):
             else:
                 await self._mb_crit("Отправка", f"{e}")
 
+    async def _send_file_cached(self, acc: Account, peer, path: str, *, ref: Optional[str] = None, **kw):
+        """send_file через кеш загрузок: один и тот же файл аккаунт грузит один раз за окно валидности."""
+        async def _upload(reader, size, name):
+            return await self._run_acc(acc, acc.client.upload_file(reader, file_size=size, file_name=name),
+                                       timeout=SETTINGS["rpc_timeout_sec"]["transfer"])
+
+        for attempt in range(2):
+            handle, digest = await self.upload_cache.input_file(acc.user_id, path, _upload)
+            try:
+                return await self._run_acc(acc, acc.client.send_file(peer, handle, **kw), action="send", ref=ref)
+            except RPCError as e:
+                # сервер уже забыл части файла — грузим заново, один раз
+                if attempt or "FILE_PART" not in (getattr(e, "message", "") or "").upper():
+                    raise
+                self.upload_cache.invalidate(acc.user_id, digest)
+
+    async def _reload_current_chat(self):
+        view_uid = self.current_view_account_id
+        if view_uid is None or not self.current_entity_ref:
+            return
+        view_acc = self.accounts.get(view_uid)
+        if view_acc:
+            ent = await self._resolve_ref(view_acc, self.current_entity_ref)
+            if ent:
+                await self._load_messages(view_acc, ent)
+
+    async def _refresh_after_send(self, sent=None, acc: Optional[Account] = None):
+        """
+        Обновление ленты после отправки: отправленное показываем сразу (локальное эхо),
+        остальное новое добираем по min_id. Полная перезагрузка — только если окно не у живого края.
+        """
+        h = self._history
+        if not h or h.ref != self.current_entity_ref or h.has_newer or not h.pages:
+            return await self._reload_current_chat()
+        since = h.newest_id
+        # id в личках/обычных группах у каждого аккаунта свои — эхо годится только от аккаунта просмотра или из канала
+        echo = [m for m in (sent if isinstance(sent, list) else [sent])
+                if isinstance(m, types.Message) and m.id > since
+                and (acc is h.src or isinstance(m.peer_id, types.PeerChannel))]
+        if echo:
+            self._merge_live_messages(h, echo)
+        limit = int(SETTINGS["history_page_size"])
+        try:
+            peer = await self._resolve_ref(h.src, h.ref)
+            if not peer:
+                return
+            msgs = await self._run_acc(h.src, h.src.client.get_messages(peer, limit=limit, min_id=since),
+                                       kind="get_messages", ref=h.ref)
+        except Exception as e:
+            print(f"[HISTORY] {e}")
+            return
+        if h is not self._history or h.has_newer:
+            return
+        fresh = list(msgs)
+        if len(fresh) >= limit:
+            return await self._reload_current_chat()  # пропущено больше страницы — проще перечитать
+        self._merge_live_messages(h, fresh)
+        self.message_store.put(h.src.user_id, utils.get_peer_id(h.entity), fresh)
+        self._apply_reply_kb_delta(fresh)
+
+    def _merge_live_messages(self, h: ChatHistory, msgs: List[types.Message]):
+        """Вставляет новые сообщения в верх окна по порядку id; уже показанные заменяет свежей версией."""
+        head = h.pages[0]
+        sb = self.chat_view.verticalScrollBar()
+        value = sb.value()
+        shift = 0
+        for m in sorted(msgs, key=lambda x: x.id):
+            row = self._make_chat_row(h, m)
+            pos = next((i for i, x in enumerate(head) if x.id <= m.id), len(head))
+            if pos < len(head) and head[pos].id == m.id:
+                head[pos] = m
+                self.chat_view.refresh(self.chat_model.replace_row(row))
+                continue
+            head.insert(pos, m)
+            self.chat_model.insert_rows(pos, [row])
+            shift += self.chat_view.row_height(row)
+        self._trim_history(h)
+        self._last_loaded_messages = h.messages()
+        if shift and value > 0:
+            # пользователь листает ниже — не сдвигаем то, что он читает
+            self.chat_view.settle()
+            sb.setValue(value + shift)
+
+    def _trim_history(self, h: ChatHistory):
+        """
+        Окно не больше page_size × загруженных страниц: новое сверху вытесняет самые старые
+        сообщения снизу (при одной странице — просто обрезка головы до page_size).
+        """
+        limit = int(SETTINGS["history_page_size"]) * max(1, len(h.pages))
+        total = sum(len(p) for p in h.pages)
+        gone: Set[int] = set()
+        while total > limit and h.pages:
+            last = h.pages[-1]
+            k = min(len(last), total - limit)
+            gone.update(m.id for m in last[len(last) - k:])
+            del last[len(last) - k:]
+            total -= k
+            if not last and len(h.pages) > 1:
+                h.pages.pop()
+        if gone:
+            h.has_older = True
+            self.chat_model.remove_ids(gone)
+
+    def _apply_reply_kb_delta(self, msgs: List[types.Message]):
+        for m in msgs:  # от новых к старым — берём самую свежую разметку
+            rm = getattr(m, "reply_markup", None)
+            if isinstance(rm, (types.ReplyKeyboardMarkup, types.ReplyKeyboardHide)):
+                self._reply_kb = rm if isinstance(rm, types.ReplyKeyboardMarkup) else None
+                self._render_reply_keyboard(self._reply_kb)
+                return
+
+    # ----- Рассылка с нескольких аккаунтов -----
+    async def _on_broadcast(self):
+        text = self.input.text().strip()
+        if not text and not self._pending_file_path:
+            return await self._mb_info("Рассылка", "Введите текст или прикрепите файл.")
+        if not self.current_entity_ref:
+            return await self._mb_info("Рассылка", "Откройте чат.")
+        if not self.accounts:
+            return await self._mb_info("Рассылка", "Нет аккаунтов.")
+        rows = [(uid, self._acc_human(a), self.scheduler.is_cooling(uid)) for uid, a in self.accounts.items()]
+        dlg = BroadcastDialog(self.current_entity_title, rows, self)
+        self._broadcast_dialog = dlg
+        ref = self.current_entity_ref
+        reply_to_id = self._main_reply_target.id if self._main_reply_target else None
+        path = self._pending_file_path
+        dlg.startRequested.connect(
+            lambda uids: asyncio.create_task(self._run_broadcast(dlg, uids, ref, text, path, reply_to_id))
+        )
+        dlg.finished.connect(lambda *_: setattr(self, "_broadcast_dialog", None))
+        dlg.show()
+
+    async def _run_broadcast(self, dlg: BroadcastDialog, uids: List[int], ref: str,
+                             text: str, path: Optional[str], reply_to_id: Optional[int]):
+        sem = asyncio.Semaphore(max(1, int(SETTINGS.get("broadcast_concurrency") or 1)))
+        lo, hi = (list(SETTINGS.get("broadcast_jitter_sec") or [0, 0]) + [0, 0])[:2]
+        counts = {"ok": 0, "flood": 0, "denied": 0, "error": 0}
+
+        async def _one(uid: int):
+            acc = self.accounts.get(uid)
+            if not acc:
+                return
+            async with sem:
+                if self.scheduler.is_cooling(uid):
+                    counts["flood"] += 1
+                    return dlg.set_status(uid, f"на лимите ещё {int(self.scheduler.cooldown_left(uid)) + 1} с", "#e3b341")
+                await asyncio.sleep(random.uniform(float(lo), float(max(lo, hi))))
+                dlg.set_status(uid, "отправка…", "#9fb3d9")
+                try:
+                    ip = await self._get_input_peer(acc, ref)
+                    if not ip:
+                        counts["denied"] += 1
+                        return dlg.set_status(uid, "нет доступа", "#ff7b7b")
+                    if path:
+                        await self._send_file_cached(acc, ip, path, caption=text or None, reply_to=reply_to_id,
+                                                     ref=ref)
+                    else:
+                        await self._run_acc(acc, acc.client.send_message(ip, text, reply_to=reply_to_id),
+                                            action="send", ref=ref)
+                    counts["ok"] += 1
+                    dlg.set_status(uid, "ok", "#a0e6a0")
+                except FloodWaitError as e:
+                    counts["flood"] += 1
+                    dlg.set_status(uid, f"лимит ({getattr(e, 'seconds', '?')} с)", "#e3b341")
+                except PeerFloodError:
+                    counts["flood"] += 1
+                    dlg.set_status(uid, "лимит (PeerFlood)", "#e3b341")
+                except (ChatWriteForbiddenError, ChannelPrivateError,
+                        UserBannedInChannelError, ChatAdminRequiredError):
+                    counts["denied"] += 1
+                    dlg.set_status(uid, "нет доступа", "#ff7b7b")
+                except Exception as e:
+                    counts["error"] += 1
+                    if self._is_frozen_error(e):
+                        dlg.set_status(uid, "заморожен", "#ff7b7b")
+                        await self._kill_account(acc, "Аккаунт заморожен (read-only)")
+                    else:
+                        dlg.set_status(uid, f"ошибка: {e}", "#ff7b7b")
+
+        if path:
+            try:
+                await self.upload_cache.prepare(path)  # читаем и хешируем файл один раз до старта
+            except OSError as e:
+                return dlg.set_summary(f"Файл недоступен: {e}")
+        await asyncio.gather(*(_one(uid) for uid in uids))
+        dlg.set_summary(f"Готово: ok {counts['ok']}, лимит {counts['flood']}, "
+                        f"нет доступа {counts['denied']}, ошибки {counts['error']}")
+        if counts["ok"]:
+            if ref == self.current_entity_ref:
+                self.input.clear(); self._clear_main_reply_target()
+                if path and path == self._pending_file_path:
+                    self._set_pending_main_file(None)
+            # ленту обновляем один раз — после всей рассылки, добором новых сообщений
+            await self._refresh_after_send()
+        self._update_labels()
+
     async def _on_attach(self):
         fn, _ = QFileDialog.getOpenFileName(self, "Выбрать файл (картинка/медиа)", "",
                                             "Изображения/медиа (*.png *.jpg *.jpeg *.gif *.webp *.mp4 *.mov *.webm);;Все файлы (*.*)")
@@ -2152,21 +4922,15 @@ class MainWindow(QMainWindow):
             return
         acc = await self._choose_account_for_send(advance=True)
         if not acc:
-            await self._mb_warn("Клавиатура", "Нет доступного аккаунта.")
+            await self._mb_warn("Клавиатура", self._no_account_text())
             return
         try:
             ip = await self._get_input_peer(acc, self.current_entity_ref)
             if not ip:
                 return await self._mb_warn("Клавиатура", "Нет доступа к чату.")
-            await self._run_acc(acc, acc.client.send_message(ip, t))
-            # перезагрузка чата (клавиатура могла измениться)
-            view_uid = self.current_view_account_id
-            if view_uid is not None:
-                view_acc = self.accounts.get(view_uid)
-                if view_acc:
-                    ent = await resolve_ref(view_acc.client, self.current_entity_ref)
-                    if ent:
-                        await self._load_messages(view_acc, ent)
+            sent = await self._run_acc(acc, acc.client.send_message(ip, t), action="send")
+            # добор новых сообщений (клавиатура могла измениться)
+            await self._refresh_after_send(sent, acc)
         except Exception as e:
             await self._mb_warn("Клавиатура", f"{e}")
     
@@ -2177,9 +4941,9 @@ class MainWindow(QMainWindow):
     async def _on_react_in_chat(self, msg: types.Message, emoji: str):
         if not emoji or not self.current_entity_ref:
             return
-        chosen = self._choose_account_for_reaction()
+        chosen = await self._choose_account_for_reaction()
         if not chosen:
-            return await self._mb_warn("Реакции", "Нет доступного аккаунта.")
+            return await self._mb_warn("Реакции", self._no_account_text())
         key = self._react_key(self.current_entity_ref, msg.id, chosen.user_id)
         if self._react_mem.get(key) == emoji:
             return await self._mb_info("Реакции", "Этот аккаунт уже ставил такую реакцию на этот пост.")
@@ -2191,19 +4955,17 @@ class MainWindow(QMainWindow):
                 peer=ip, msg_id=msg.id,
                 reaction=[types.ReactionEmoji(emoticon=emoji)],
                 add_to_recent=True
-            )))
-            b = self._find_chat_bubble(msg.id)
-            if b:
-                b.apply_reaction(emoji, +1)
+            )), action="react")
+            self._update_chat_row(msg.id, lambda r: r.apply_reaction(emoji, +1))
             self._react_mem[key] = emoji
-            save_json(REACTIONS_CACHE_FILE, self._react_mem)
+            state_writer.write(REACTIONS_CACHE_FILE, self._react_mem)
         except (PeerFloodError, FloodWaitError) as e:
             await self._mb_warn("Реакции", f"Лимит: {e}")
         except Exception as e:
             await self._mb_warn("Реакции", f"{e}")
         finally:
-            if self.cb_switch_after_reaction.isChecked() and self.rr_order:
-                self._rr_pointer = (self._rr_pointer + 1) % len(self.rr_order)
+            if self.cb_switch_after_reaction.isChecked():
+                self.scheduler.rotate()
             self._update_labels()
 
     async def _on_inline_button(self, msg: types.Message, info: dict):
@@ -2234,7 +4996,7 @@ class MainWindow(QMainWindow):
 
             if kind == "callback":
                 data = (info or {}).get("data", None)
-                await self._run_acc(acc, acc.client(GetBotCallbackAnswerRequest(peer=ip, msg_id=msg.id, data=data)))
+                await self._run_acc(acc, acc.client(GetBotCallbackAnswerRequest(peer=ip, msg_id=msg.id, data=data)), action="send")
             elif kind == "switch_inline":
                 await self._mb_info("Кнопки", "Кнопка 'Switch Inline' пока не поддерживается. Введите запрос вручную через @бот.")
             else:
@@ -2243,25 +5005,59 @@ class MainWindow(QMainWindow):
             await self._mb_warn("Кнопки", f"{e}")
 
     # ----- Комментарии / обсуждения -----
-    async def _get_discussion_chat(self, client: TelegramClient, channel_entity):
+    async def _allowed_reactions(self, acc: Account, entity, *, priority: Optional[int] = None) -> List[str]:
+        """Разрешённые реакции чата: из кеша без запроса, иначе один GetFullChannel."""
+        if not isinstance(entity, types.Channel):
+            return DEFAULT_REACTION_EMOJIS
+        cached = reaction_policy.get(entity.id)
+        if cached is not None:
+            return cached
+        return await self._run_acc(acc, get_allowed_reaction_emojis(acc.client, entity),
+                                   priority=priority, kind="get_full_channel")
+
+    async def _get_discussion_chat(self, acc: Account, channel_entity, *, priority: Optional[int] = None):
+        cid = getattr(channel_entity, "id", None)
+        hit = self.discussion_cache.get_discussion(acc.user_id, cid)
+        if hit is not DiscussionCache.MISS:
+            return hit
         try:
-            full = await client(GetFullChannelRequest(channel_entity))
+            full = await self._run_acc(acc, acc.client(GetFullChannelRequest(channel_entity)),
+                                       priority=priority, kind="get_full_channel")
+            reaction_policy.put(cid, getattr(full.full_chat, "available_reactions", None))
             linked_id = getattr(full.full_chat, 'linked_chat_id', None)
-            if not linked_id: return None
-            try:
-                return await client.get_entity(types.PeerChannel(linked_id))
-            except Exception:
-                return await client.get_entity(linked_id)
+            discussion = None
+            if linked_id:
+                # привязанный чат уже лежит в full.chats — отдельный get_entity не нужен
+                discussion = next((c for c in getattr(full, "chats", []) if getattr(c, "id", None) == linked_id), None)
+                if discussion is None:
+                    try:
+                        discussion = await self._run_acc(acc, acc.client.get_entity(types.PeerChannel(linked_id)), priority=priority)
+                    except Exception:
+                        discussion = await self._run_acc(acc, acc.client.get_entity(linked_id), priority=priority)
         except Exception:
             return None
+        self.discussion_cache.put_discussion(acc.user_id, cid, discussion)
+        return discussion
 
-    async def _fetch_comments_via_getreplies(self, acc: Account, channel, post_id: int, limit=400):
+    async def _fetch_comments_via_getreplies(self, acc: Account, channel, post_id: int, limit=400,
+                                             priority: Optional[int] = None):
         try:
-            res = await self._run_acc(acc, acc.client(GetRepliesRequest(
-                peer=channel, msg_id=post_id,
-                offset_id=0, offset_date=None, add_offset=0, limit=limit,
-                max_id=0, min_id=0, hash=0
-            )))
+            if priority == PRIO_BACKGROUND:
+                # фоновый опрос не дублируем — подстраховка только для того, что ждёт пользователь
+                res = await self._run_acc(acc, acc.client(GetRepliesRequest(
+                    peer=channel, msg_id=post_id,
+                    offset_id=0, offset_date=None, add_offset=0, limit=limit,
+                    max_id=0, min_id=0, hash=0
+                )), priority=priority, kind="get_replies")
+            else:
+                res, _ = await self._hedged_read(
+                    acc, channel, entity_ref(channel),
+                    lambda a, peer: a.client(GetRepliesRequest(
+                        peer=peer, msg_id=post_id,
+                        offset_id=0, offset_date=None, add_offset=0, limit=limit,
+                        max_id=0, min_id=0, hash=0
+                    )), kind="get_replies"
+                )
             msgs = list(getattr(res, "messages", []))
             msgs.sort(key=lambda m: (m.date or 0), reverse=True)
             return msgs
@@ -2269,27 +5065,48 @@ class MainWindow(QMainWindow):
             return []
 
     async def _iter_comments_for_post(self, acc: Account, channel_entity, channel_msg_id, limit=400):
-        discussion = await self._get_discussion_chat(acc.client, channel_entity)
+        """(обсуждение, комментарии, полный ли список) — False, если скан обсуждения оборван по таймауту."""
+        discussion = await self._get_discussion_chat(acc, channel_entity)
         if not discussion:
-            return None, []
-        await self._run_acc(acc, ensure_join(acc.client, discussion))
+            return None, [], True
+        await self._ensure_join(acc, discussion)
 
         comments = await self._fetch_comments_via_getreplies(acc, channel_entity, channel_msg_id, limit=limit)
         if comments:
-            return discussion, comments
+            return discussion, comments, True
 
         fallback: List[types.Message] = []
-        async with acc.api_lock:
-            async for m in acc.client.iter_messages(discussion, limit=limit):
-                rt = getattr(m, "reply_to", None)
-                top_id = getattr(rt, "reply_to_top_id", None) if rt else None
-                mid = getattr(rt, "reply_to_msg_id", None) if rt else None
-                if top_id == channel_msg_id or mid == channel_msg_id:
-                    fallback.append(m)
+
+        async def _scan():
+            async with acc.rpc:
+                async for m in acc.client.iter_messages(discussion, limit=limit):
+                    rt = getattr(m, "reply_to", None)
+                    top_id = getattr(rt, "reply_to_top_id", None) if rt else None
+                    mid = getattr(rt, "reply_to_msg_id", None) if rt else None
+                    if top_id == channel_msg_id or mid == channel_msg_id:
+                        fallback.append(m)
+        complete = True
+        try:
+            await asyncio.wait_for(_scan(), self._rpc_budget(PRIO_NORMAL, None))
+        except asyncio.TimeoutError:
+            complete = False
+            self._mark_degraded(acc, "iter_messages", self._rpc_budget(PRIO_NORMAL, None) or 0)
         fallback.sort(key=lambda m: (m.date or 0), reverse=True)
-        return discussion, fallback
+        return discussion, fallback, complete
+
+    def _mark_comments_partial(self):
+        self.comments.title.setText(self.comments.title.text() + " • список неполный (таймаут)")
 
     async def _get_discussion_root_id(self, acc: Account, channel_entity, post_id: int, discussion) -> Optional[int]:
+        cached = self.discussion_cache.get_root(channel_entity.id, int(post_id))
+        if cached:
+            return cached
+        root = await self._fetch_discussion_root_id(acc, channel_entity, post_id, discussion)
+        if root:
+            self.discussion_cache.put_root(channel_entity.id, int(post_id), root)
+        return root
+
+    async def _fetch_discussion_root_id(self, acc: Account, channel_entity, post_id: int, discussion) -> Optional[int]:
         try:
             res = await self._run_acc(acc, acc.client(GetDiscussionMessageRequest(
                 peer=channel_entity, msg_id=int(post_id)
@@ -2310,27 +5127,29 @@ class MainWindow(QMainWindow):
         real_post_id = msg.id
         self.comments.clear_comments(f"Комментарии к посту {real_post_id} • {self.current_entity_title}")
         try:
-            discussion = await self._get_discussion_chat(acc.client, entity)
+            discussion = await self._get_discussion_chat(acc, entity)
             if not discussion:
                 return await self._mb_info("Комментарии", "Комментарии недоступны для этого поста.")
-            await self._run_acc(acc, ensure_join(acc.client, discussion))
+            await self._ensure_join(acc, discussion)
 
             root_id = await self._get_discussion_root_id(acc, entity, real_post_id, discussion)
 
-            _, comments = await self._iter_comments_for_post(acc, entity, real_post_id, limit=500)
-            allowed = await self._run_acc(acc, get_allowed_reaction_emojis(acc.client, discussion))
+            _, comments, complete = await self._iter_comments_for_post(acc, entity, real_post_id, limit=500)
+            if not complete:
+                self._mark_comments_partial()
+            allowed = await self._allowed_reactions(acc, discussion)
             self._comments_known_ids = set()
             for cm in comments:
                 bub = self.comments.add_comment_bubble(cm, bool(cm.out), emojis=allowed)
                 self._comments_known_ids.add(cm.id)
-                asyncio.create_task(self._maybe_resolve_and_set_author(acc.client, bub, cm))
+                asyncio.create_task(self._maybe_resolve_and_set_author(acc, bub, cm))
 
             self._comments_ctx_entity_ref = entity_ref(entity)
             self._comments_ctx_post_id = real_post_id
             self._comments_ctx_root_discussion_id = root_id
             self._comments_ctx_acc = acc
-            if not self._comments_timer.isActive():
-                self._comments_timer.start()
+            self._comments_ctx_discussion_id = utils.get_peer_id(discussion)
+            self._comments_ctx_allowed = allowed
         except Exception as e:
             if self._is_frozen_error(e):
                 await self._kill_account(acc, "Аккаунт заморожен (read-only)")
@@ -2345,13 +5164,13 @@ class MainWindow(QMainWindow):
             return
         acc = self.accounts[uid]
         try:
-            channel_entity = await self._run_acc(acc, resolve_ref(acc.client, self._comments_ctx_entity_ref))
+            channel_entity = await self._resolve_ref(acc, self._comments_ctx_entity_ref)
             if not channel_entity:
                 return
-            discussion = await self._get_discussion_chat(acc.client, channel_entity)
+            discussion = await self._get_discussion_chat(acc, channel_entity)
             if not discussion:
                 return
-            await self._run_acc(acc, ensure_join(acc.client, discussion))
+            await self._ensure_join(acc, discussion)
 
             self._comments_ctx_root_discussion_id = await self._get_discussion_root_id(
                 acc, channel_entity, int(self._comments_ctx_post_id), discussion
@@ -2359,38 +5178,18 @@ class MainWindow(QMainWindow):
 
             self.comments.clear_comments(f"Комментарии к посту {self._comments_ctx_post_id} • {self.current_entity_title}")
 
-            _, comments = await self._iter_comments_for_post(acc, channel_entity, int(self._comments_ctx_post_id), limit=500)
-            allowed = await self._run_acc(acc, get_allowed_reaction_emojis(acc.client, discussion))
+            _, comments, complete = await self._iter_comments_for_post(acc, channel_entity, int(self._comments_ctx_post_id), limit=500)
+            if not complete:
+                self._mark_comments_partial()
+            allowed = await self._allowed_reactions(acc, discussion)
             self._comments_known_ids = set()
             for cm in comments:
                 bub = self.comments.add_comment_bubble(cm, bool(cm.out), emojis=allowed)
                 self._comments_known_ids.add(cm.id)
-                asyncio.create_task(self._maybe_resolve_and_set_author(acc.client, bub, cm))
-            if not self._comments_timer.isActive():
-                self._comments_timer.start()
-        except Exception:
-            pass
-
-    async def _refresh_comments_tick(self):
-        if not (self._comments_ctx_entity_ref and self._comments_ctx_post_id and self._comments_ctx_acc):
-            return
-        acc = self._comments_ctx_acc
-        try:
-            channel_entity = await self._run_acc(acc, resolve_ref(acc.client, self._comments_ctx_entity_ref))
-            if not channel_entity:
-                return
-            discussion = await self._get_discussion_chat(acc.client, channel_entity)
-            if not discussion:
-                return
-            latest = await self._fetch_comments_via_getreplies(acc, channel_entity, int(self._comments_ctx_post_id), limit=60)
-            if not latest:
-                return
-            allowed = await self._run_acc(acc, get_allowed_reaction_emojis(acc.client, discussion))
-            for cm in latest:
-                if cm.id not in self._comments_known_ids:
-                    bub = self.comments.add_comment_bubble_top(cm, bool(cm.out), emojis=allowed)
-                    self._comments_known_ids.add(cm.id)
-                    asyncio.create_task(self._maybe_resolve_and_set_author(acc.client, bub, cm))
+                asyncio.create_task(self._maybe_resolve_and_set_author(acc, bub, cm))
+            self._comments_ctx_acc = acc
+            self._comments_ctx_discussion_id = utils.get_peer_id(discussion)
+            self._comments_ctx_allowed = allowed
         except Exception:
             pass
 
@@ -2400,21 +5199,19 @@ class MainWindow(QMainWindow):
 
         chosen_acc = await self._choose_account_for_send(advance=True)
         if not chosen_acc:
-            return await self._mb_warn("Комментарии", "Нет доступного аккаунта.")
+            return await self._mb_warn("Комментарии", self._no_account_text())
 
         self._update_labels()
 
         try:
-            channel_entity = await self._run_acc(
-                chosen_acc, resolve_ref(chosen_acc.client, self._comments_ctx_entity_ref)
-            )
+            channel_entity = await self._resolve_ref(chosen_acc, self._comments_ctx_entity_ref)
             if not channel_entity:
                 return await self._mb_warn("Комментарии", "Не удалось получить канал.")
 
-            discussion = await self._get_discussion_chat(chosen_acc.client, channel_entity)
+            discussion = await self._get_discussion_chat(chosen_acc, channel_entity)
             if not discussion:
                 return await self._mb_warn("Комментарии", "У поста нет доступной ветки комментариев.")
-            await self._run_acc(chosen_acc, ensure_join(chosen_acc.client, discussion))
+            await self._ensure_join(chosen_acc, discussion)
 
             post_id = int(self._comments_ctx_post_id)
             root_id = self._comments_ctx_root_discussion_id
@@ -2431,13 +5228,10 @@ class MainWindow(QMainWindow):
             if self._comments_pending_file_path:
                 path = Path(self._comments_pending_file_path)
                 self._comments_pending_file_path = None
-                sent = await self._run_acc(
-                    chosen_acc,
-                    chosen_acc.client.send_file(
-                        discussion, str(path),
-                        caption=text or "",
-                        reply_to=reply_to_id
-                    )
+                sent = await self._send_file_cached(
+                    chosen_acc, discussion, str(path),
+                    caption=text or "",
+                    reply_to=reply_to_id
                 )
                 if isinstance(sent, list):
                     sent = sent[0] if sent else None
@@ -2447,14 +5241,15 @@ class MainWindow(QMainWindow):
                     chosen_acc.client.send_message(
                         discussion, text or "",
                         reply_to=reply_to_id
-                    )
+                    ),
+                    action="send"
                 )
 
-            if isinstance(sent, types.Message):
-                allowed = await self._run_acc(chosen_acc, get_allowed_reaction_emojis(chosen_acc.client, discussion))
+            if isinstance(sent, types.Message) and sent.id not in self._comments_known_ids:
+                allowed = await self._allowed_reactions(chosen_acc, discussion)
                 bub = self.comments.add_comment_bubble_top(sent, True, emojis=allowed)
                 self._comments_known_ids.add(sent.id)
-                asyncio.create_task(self._maybe_resolve_and_set_author(chosen_acc.client, bub, sent))
+                asyncio.create_task(self._maybe_resolve_and_set_author(chosen_acc, bub, sent))
 
             self.comments.clear_reply_indicator()
             self._update_labels()
@@ -2476,33 +5271,34 @@ class MainWindow(QMainWindow):
     async def _on_react_in_comment(self, cm: types.Message, emoji: str):
         if not (self._comments_ctx_entity_ref and self._comments_ctx_post_id) or not emoji:
             return
-        chosen = self._choose_account_for_reaction()
+        chosen = await self._choose_account_for_reaction()
         if not chosen:
-            return await self._mb_warn("Реакции", "Нет доступного аккаунта.")
+            return await self._mb_warn("Реакции", self._no_account_text())
         key = self._react_key(self._comments_ctx_entity_ref or "", cm.id, chosen.user_id)
         if self._react_mem.get(key) == emoji:
             return await self._mb_info("Реакции", "Этот аккаунт уже ставил такую реакцию на этот комментарий.")
         try:
-            channel_entity = await self._run_acc(chosen, resolve_ref(chosen.client, self._comments_ctx_entity_ref))
-            discussion = await self._get_discussion_chat(chosen.client, channel_entity)
+            channel_entity = await self._resolve_ref(chosen, self._comments_ctx_entity_ref)
+            discussion = await self._get_discussion_chat(chosen, channel_entity)
             if not discussion:
                 return
-                await self._run_acc(chosen, ensure_join(chosen.client, discussion))
+                await self._ensure_join(chosen, discussion)
             ip = await chosen.client.get_input_entity(discussion)
             await self._run_acc(chosen,
                 chosen.client(SendReactionRequest(
                     peer=ip, msg_id=cm.id,
                     reaction=[types.ReactionEmoji(emoticon=emoji)], add_to_recent=True
-                ))
+                )),
+                action="react"
             )
             self.comments.update_comment_reaction(cm.id, emoji, +1)
             self._react_mem[key] = emoji
-            save_json(REACTIONS_CACHE_FILE, self._react_mem)
+            state_writer.write(REACTIONS_CACHE_FILE, self._react_mem)
         except Exception as e:
             await self._mb_warn("Реакции", f"{e}")
         finally:
-            if self.cb_switch_after_reaction.isChecked() and self.rr_order:
-                self._rr_pointer = (self._rr_pointer + 1) % len(self.rr_order)
+            if self.cb_switch_after_reaction.isChecked():
+                self.scheduler.rotate()
             self._update_labels()
 
     # ===== ПРОКСИ =====
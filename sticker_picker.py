@@ -498,13 +498,13 @@ def install_sticker_plugin(MainWindow_cls):
         ip = await self._get_input_peer(acc, self.current_entity_ref)
         if not ip:
             return await self._mb_warn("Стикер", "Нет доступа к чату.")
-        doc = await pick_sticker_dialog(self, acc.client, lock=acc.api_lock)
+        doc = await pick_sticker_dialog(self, acc.client, lock=acc.rpc)
         if not doc:
             return
         reply_to_id = getattr(self, "_main_reply_target", None)
         reply_to_id = reply_to_id.id if reply_to_id else None
         try:
-            await self._run_acc(acc, acc.client.send_file(ip, doc, reply_to=reply_to_id))
+            await self._run_acc(acc, acc.client.send_file(ip, doc, reply_to=reply_to_id), action="send")
             if hasattr(self, "_clear_main_reply_target"):
                 self._clear_main_reply_target()
             self._update_labels()
@@ -521,12 +521,11 @@ def install_sticker_plugin(MainWindow_cls):
         if not acc:
             return await self._mb_warn("Комментарии", "Нет доступного аккаунта.")
         try:
-            host = importlib.import_module(self.__class__.__module__)
-            channel = await self._run_acc(acc, host.resolve_ref(acc.client, self._comments_ctx_entity_ref))
-            discussion = await self._get_discussion_chat(acc.client, channel)
+            channel = await self._resolve_ref(acc, self._comments_ctx_entity_ref)
+            discussion = await self._get_discussion_chat(acc, channel)
             if not discussion:
                 return await self._mb_warn("Комментарии", "У поста нет ветки комментариев.")
-            await self._run_acc(acc, host.ensure_join(acc.client, discussion))
+            await self._ensure_join(acc, discussion)
 
             post_id = int(self._comments_ctx_post_id)
             root = self._comments_ctx_root_discussion_id
@@ -539,14 +538,14 @@ def install_sticker_plugin(MainWindow_cls):
             reply_target = self.comments.current_reply_target()
             reply_to_id = int(reply_target.id) if reply_target else int(root)
 
-            sent = await self._run_acc(acc, acc.client.send_file(discussion, doc, reply_to=reply_to_id))
+            sent = await self._run_acc(acc, acc.client.send_file(discussion, doc, reply_to=reply_to_id), action="send")
             if isinstance(sent, list):
                 sent = sent[0] if sent else None
-            if isinstance(sent, types.Message):
-                allowed = await self._run_acc(acc, host.get_allowed_reaction_emojis(acc.client, discussion))
+            if isinstance(sent, types.Message) and sent.id not in self._comments_known_ids:
+                allowed = await self._allowed_reactions(acc, discussion)
                 bub = self.comments.add_comment_bubble_top(sent, True, emojis=allowed)
                 self._comments_known_ids.add(sent.id)
-                asyncio.create_task(self._maybe_resolve_and_set_author(acc.client, bub, sent))
+                asyncio.create_task(self._maybe_resolve_and_set_author(acc, bub, sent))
             self.comments.clear_reply_indicator()
             self._update_labels()
         except Exception as e:
@@ -561,7 +560,6 @@ def install_sticker_plugin(MainWindow_cls):
     _orig_init_ui = getattr(MainWindow_cls, "_init_ui")
     _orig_open_comments = getattr(MainWindow_cls, "_open_comments_for_post", None)
     _orig_reopen_comments = getattr(MainWindow_cls, "_reopen_comments_for_current_account", None)
-    _orig_load_messages = getattr(MainWindow_cls, "_load_messages", None)
 
     async def _send_direct(self, doc):
         if not getattr(self, "current_entity_ref", None):
@@ -572,7 +570,7 @@ def install_sticker_plugin(MainWindow_cls):
         ip = await self._get_input_peer(acc, self.current_entity_ref)
         if not ip:
             return await self._mb_warn("Стикер", "Нет доступа к чату.")
-        await self._run_acc(acc, acc.client.send_file(ip, doc))
+        await self._run_acc(acc, acc.client.send_file(ip, doc), action="send")
         self._update_labels()
 
     def _ensure_comments_sticker_button(self):
@@ -606,7 +604,7 @@ def install_sticker_plugin(MainWindow_cls):
             acc = await MainWindow_cls._choose_account_for_send(self, advance=True)
             if not acc:
                 return await MainWindow_cls._mb_warn(self, "Комментарии", "Нет доступного аккаунта.")
-            doc = await pick_sticker_dialog(self, acc.client, lock=acc.api_lock)
+            doc = await pick_sticker_dialog(self, acc.client, lock=acc.rpc)
             if not doc: return
             await MainWindow_cls._send_sticker_to_comments(self, doc)
 
@@ -633,27 +631,8 @@ def install_sticker_plugin(MainWindow_cls):
         except Exception:
             pass
 
-    def _wire_chat_reply_buttons(self):
-        try:
-            host = importlib.import_module(self.__class__.__module__)
-            MessageBubble = getattr(host, "MessageBubble", None)
-            chat_inner = getattr(self, "chat_inner", None)
-            if not MessageBubble or chat_inner is None:
-                return
-            for b in chat_inner.findChildren(MessageBubble):
-                if getattr(b, "_reply_hooked", False):
-                    continue
-                try:
-                    b.replyClicked.connect(lambda m, self=self: self._select_main_reply_target(m))
-                    b._reply_hooked = True
-                except Exception:
-                    pass
-        except Exception:
-            pass
-
     setattr(MainWindow_cls, "_ensure_comments_sticker_button", _ensure_comments_sticker_button)
     setattr(MainWindow_cls, "_strip_comment_buttons_in_view", _strip_comment_buttons_in_view)
-    setattr(MainWindow_cls, "_wire_chat_reply_buttons", _wire_chat_reply_buttons)
 
     def _init_ui_patched(self, *a, **kw):
         _orig_init_ui(self, *a, **kw)
@@ -708,7 +687,7 @@ def install_sticker_plugin(MainWindow_cls):
                 if uid is not None and uid in self.accounts:
                     acc = self.accounts[uid]
                     if getattr(self, "_sticker_shelf_chat", None):
-                        self._sticker_shelf_chat.set_client(acc.client, acc.api_lock)
+                        self._sticker_shelf_chat.set_client(acc.client, acc.rpc)
             except Exception:
                 pass
         setattr(MainWindow_cls, "_on_account_changed", _on_account_changed_patched)
@@ -727,10 +706,3 @@ def install_sticker_plugin(MainWindow_cls):
             self._ensure_comments_sticker_button()
             self._strip_comment_buttons_in_view()
         setattr(MainWindow_cls, "_reopen_comments_for_current_account", _reopen_comments_patched)
-
-    # после загрузки сообщений — цепляем «Ответить», чтобы стикер уходил как reply
-    if _orig_load_messages:
-        async def _load_messages_patched(self, *a, **kw):
-            await _orig_load_messages(self, *a, **kw)
-            self._wire_chat_reply_buttons()
-        setattr(MainWindow_cls, "_load_messages", _load_messages_patched)